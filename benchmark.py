@@ -0,0 +1,550 @@
+"""Benchmark offline de MikalabazaBot.
+
+Levanta un servidor aiohttp local que imita a TMDB y OMDB (latencia, tasa de
+errores y respuestas enlatadas configurables) y un Bot de Telegram falso, y
+reproduce una mezcla de búsquedas y pulsaciones de botones a través de
+handle_message y button_callback. Informa de p50/p95/p99, updates por
+segundo y peticiones a las APIs por update.
+
+Uso:
+    python benchmark.py                               # mezcla sintética
+    python benchmark.py --replay mezcla.jsonl         # una línea JSON por update
+    python benchmark.py --save base.json              # guardar como referencia
+    python benchmark.py --baseline base.json          # comparar con la referencia
+
+Formato de --replay (en orden; los updates de un mismo chat se reproducen en
+secuencia y los chats distintos en paralelo):
+    {"chat": 1, "text": "matrix"}
+    {"chat": 1, "click": "ratings"}       # botón del último mensaje del bot en ese chat
+    {"chat": -5, "text": "dark", "group": true}
+    {"chat": 7, "inline": "dark"}          # modo inline, tecleado letra a letra
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+from aiohttp import web
+from telegram import Bot, Update
+
+import main
+
+BENCH_HOST = "127.0.0.1"
+BENCH_PORT = 8799
+ACTIONS = ("basic", "ratings", "cast", "watch")
+KEYSTROKE_INTERVAL = 0.12  # segundos entre teclas en las consultas inline
+
+# Catálogo enlatado: (título, título original, fecha, tipo)
+CATALOG_TITLES = [
+    ("Matrix", "The Matrix", "1999-03-31", "movie"),
+    ("El padrino", "The Godfather", "1972-03-14", "movie"),
+    ("Origen", "Inception", "2010-07-15", "movie"),
+    ("Interstellar", "Interstellar", "2014-11-05", "movie"),
+    ("El club de la lucha", "Fight Club", "1999-10-15", "movie"),
+    ("Pulp Fiction", "Pulp Fiction", "1994-09-10", "movie"),
+    ("El caballero oscuro", "The Dark Knight", "2008-07-16", "movie"),
+    ("Parásitos", "기생충", "2019-05-30", "movie"),
+    ("Amélie", "Le Fabuleux Destin d'Amélie Poulain", "2001-04-25", "movie"),
+    ("El laberinto del fauno", "El laberinto del fauno", "2006-10-11", "movie"),
+    ("Regreso al futuro", "Back to the Future", "1985-07-03", "movie"),
+    ("Gladiator", "Gladiator", "2000-05-01", "movie"),
+    ("Titanic", "Titanic", "1997-11-18", "movie"),
+    ("Oppenheimer", "Oppenheimer", "2023-07-19", "movie"),
+    ("Dune", "Dune", "2021-09-15", "movie"),
+    ("Breaking Bad", "Breaking Bad", "2008-01-20", "tv"),
+    ("Dark", "Dark", "2017-12-01", "tv"),
+    ("La casa de papel", "La casa de papel", "2017-05-02", "tv"),
+    ("Juego de tronos", "Game of Thrones", "2011-04-17", "tv"),
+    ("Stranger Things", "Stranger Things", "2016-07-15", "tv"),
+    ("Los Soprano", "The Sopranos", "1999-01-10", "tv"),
+    ("The Office", "The Office", "2005-03-24", "tv"),
+    ("Succession", "Succession", "2018-06-03", "tv"),
+    ("The Wire", "The Wire", "2002-06-02", "tv"),
+]
+
+# Mensajes de grupo que no son títulos (los debe descartar el pre-filtro)
+GROUP_CHATTER = ["jajaja", "buenas noches a todos", "alguien vio el partido ayer", "ok", "que tal"]
+
+
+class FakeCatalog:
+    """Respuestas enlatadas con el tamaño y la forma de las de TMDB y OMDB"""
+
+    def __init__(self):
+        self.titles = {}
+        for tmdb_id, (title, original, date, media_type) in enumerate(CATALOG_TITLES, start=100):
+            self.titles[tmdb_id] = {
+                "id": tmdb_id,
+                "media_type": media_type,
+                "title": title,
+                "original_title": original,
+                "date": date,
+                "imdb_id": f"tt{tmdb_id:07d}",
+                "words": set(main.normalize_query(f"{title} {original}").split())
+            }
+
+    def _result(self, entry):
+        if entry["media_type"] == "tv":
+            names = {"name": entry["title"], "original_name": entry["original_title"],
+                     "first_air_date": entry["date"]}
+        else:
+            names = {"title": entry["title"], "original_title": entry["original_title"],
+                     "release_date": entry["date"]}
+        return dict(names, id=entry["id"], media_type=entry["media_type"], poster_path=f"/p{entry['id']}.jpg",
+                    backdrop_path=f"/b{entry['id']}.jpg", overview="Sinopsis " * 40, popularity=50.0,
+                    vote_average=7.9, vote_count=12000, genre_ids=[18, 28], original_language="en")
+
+    def search(self, query, media_type):
+        words = set(main.normalize_query(query).split())
+        results = [
+            self._result(entry) for entry in self.titles.values()
+            if words & entry["words"] and media_type in ("multi", entry["media_type"])
+        ]
+        if media_type != "multi":
+            for result in results:
+                del result["media_type"]
+        # TMDB también devuelve personas en /search/multi
+        if media_type == "multi" and results:
+            results.append({"id": 1, "media_type": "person", "name": query, "known_for": []})
+        return {"page": 1, "results": results, "total_results": len(results), "total_pages": 1}
+
+    def trending(self, media_type):
+        """Listas de tendencias/populares: todo el catálogo o solo un tipo"""
+        results = [self._result(entry) for entry in self.titles.values()
+                   if media_type in ("all", entry["media_type"])]
+        if media_type != "all":
+            for result in results:
+                del result["media_type"]
+        return {"page": 1, "results": results, "total_results": len(results), "total_pages": 1}
+
+    def details(self, tmdb_id, media_type):
+        entry = self.titles.get(tmdb_id)
+        if entry is None or entry["media_type"] != media_type:
+            return None
+        data = self._result(entry)
+        del data["media_type"]
+        data.update(
+            genres=[{"id": 18, "name": "Drama"}, {"id": 28, "name": "Acción"}],
+            runtime=120,
+            episode_run_time=[50],
+            number_of_seasons=4,
+            number_of_episodes=40,
+            status="Released",
+            created_by=[{"id": 9, "name": "Creador Uno"}],
+            credits={
+                "cast": [{"id": i, "name": f"Actor {i}", "character": f"Personaje {i}",
+                          "profile_path": f"/a{i}.jpg", "order": i} for i in range(40)],
+                "crew": [{"id": i, "name": f"Equipo {i}", "job": "Director" if i < 2 else "Writer",
+                          "department": "Directing"} for i in range(60)]
+            },
+            videos={"results": [{"key": f"video{i}", "site": "YouTube", "type": "Trailer"} for i in range(10)]},
+            external_ids={"imdb_id": entry["imdb_id"]},
+            alternative_titles={"titles": [{"iso_3166_1": "MX", "title": entry["original_title"]}]}
+        )
+        return data
+
+    def omdb(self, params):
+        entry = None
+        if "i" in params:
+            entry = next((e for e in self.titles.values() if e["imdb_id"] == params["i"]), None)
+        elif "t" in params:
+            words = set(main.normalize_query(params["t"]).split())
+            entry = next((e for e in self.titles.values() if words & e["words"]), None)
+        if entry is None:
+            return {"Response": "False", "Error": "Movie not found!"}
+        return {
+            "Response": "True",
+            "Title": entry["original_title"],
+            "Type": "movie" if entry["media_type"] == "movie" else "series",
+            "Year": entry["date"][:4],
+            "imdbRating": "8.1",
+            "Ratings": [
+                {"Source": "Internet Movie Database", "Value": "8.1/10"},
+                {"Source": "Rotten Tomatoes", "Value": "88%"},
+                {"Source": "Metacritic", "Value": "74/100"}
+            ],
+            "Plot": "Argumento " * 60
+        }
+
+
+class FakeUpstreams:
+    """Servidor aiohttp local que sustituye a TMDB y OMDB"""
+
+    def __init__(self, catalog, latency, jitter, error_rate, seed):
+        self.catalog = catalog
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self._runner = None
+
+    async def _respond(self, upstream, build):
+        self.calls[upstream] += 1
+        await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+        if self.random.random() < self.error_rate:
+            self.errors[upstream] += 1
+            return web.Response(status=503)
+        data = build()
+        if data is None:
+            return web.json_response({"status_code": 34, "status_message": "Not found"}, status=404)
+        return web.json_response(data)
+
+    async def search(self, request):
+        return await self._respond("tmdb", lambda: self.catalog.search(
+            request.query.get("query", ""), request.match_info["media_type"]))
+
+    async def details(self, request):
+        return await self._respond("tmdb", lambda: self.catalog.details(
+            int(request.match_info["tmdb_id"]), request.match_info["media_type"]))
+
+    async def trending(self, request):
+        return await self._respond("tmdb", lambda: self.catalog.trending(request.match_info["media_type"]))
+
+    async def omdb(self, request):
+        return await self._respond("omdb", lambda: self.catalog.omdb(request.query))
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get("/tmdb/search/{media_type}", self.search)
+        app.router.add_get("/tmdb/{media_type:movie|tv}/{tmdb_id:\\d+}", self.details)
+        app.router.add_get("/tmdb/trending/{media_type}/day", self.trending)
+        app.router.add_get("/tmdb/{media_type:movie|tv}/popular", self.trending)
+        app.router.add_get("/omdb", self.omdb)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class FakeBot(Bot):
+    """Bot de Telegram que responde localmente en lugar de llamar a la Bot API"""
+
+    def __init__(self, latency=0.0):
+        super().__init__("123456:benchmark")
+        # Los objetos de python-telegram-bot quedan congelados tras __init__
+        with self._unfrozen():
+            self.latency = latency
+            self.calls = Counter()
+            self.last_message = {}  # chat_id -> último mensaje enviado o editado (dict)
+            self._message_ids = itertools.count(1)
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "bench_bot"}
+        if endpoint in ("sendMessage", "sendPhoto"):
+            return self._store(data, {"message_id": next(self._message_ids)})
+        if "inline_message_id" in data:
+            # Los mensajes enviados en modo inline no se devuelven al editarlos
+            return True
+        if endpoint in ("editMessageText", "editMessageCaption"):
+            return self._store(data, dict(self.last_message.get(int(data["chat_id"]), {})))
+        return True
+
+    def _store(self, data, message):
+        chat_id = int(data["chat_id"])
+        message.update(date=int(time.time()), chat={"id": chat_id, "type": "group" if chat_id < 0 else "private"})
+        if "photo" in data:
+            file_id = data["photo"] if isinstance(data["photo"], str) and not data["photo"].startswith("http") \
+                else f"file-{abs(hash(str(data['photo'])))}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 500, "height": 750}]
+        for field in ("text", "caption"):
+            if field in data:
+                message[field] = data[field]
+        if "reply_markup" in data:
+            markup = data["reply_markup"]
+            message["reply_markup"] = markup.to_dict() if hasattr(markup, "to_dict") else markup
+        self.last_message[chat_id] = message
+        return message
+
+
+class Driver:
+    """Construye Updates como los de Telegram y los pasa por los handlers del bot"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.context = SimpleNamespace(bot=bot)
+        self._update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)  # tipo de update -> segundos
+        self.skipped = 0
+
+    def _user(self, chat_id):
+        return {"id": abs(chat_id), "is_bot": False, "first_name": f"Usuario {abs(chat_id)}"}
+
+    async def message(self, chat_id, text, group=False):
+        chat = {"id": chat_id, "type": "group", "title": "Grupo"} if group else {"id": chat_id, "type": "private"}
+        update = Update.de_json({
+            "update_id": next(self._update_ids),
+            "message": {"message_id": next(self._update_ids), "date": int(time.time()), "chat": chat,
+                        "from": self._user(chat_id), "text": text}
+        }, self.bot)
+        await self._run("group_message" if group else "message", main.handle_message, update)
+
+    async def click(self, chat_id, action):
+        message = self.bot.last_message.get(chat_id)
+        buttons = [button for row in (message or {}).get("reply_markup", {}).get("inline_keyboard", [])
+                   for button in row if button.get("callback_data", "").startswith(f"{action}|")]
+        if not buttons:
+            # El mensaje anterior no tenía teclado (p. ej. "no encontré resultados")
+            self.skipped += 1
+            return
+
+        update = Update.de_json({
+            "update_id": next(self._update_ids),
+            "callback_query": {"id": str(next(self._update_ids)), "from": self._user(chat_id),
+                               "chat_instance": str(chat_id), "data": buttons[0]["callback_data"],
+                               "message": message}
+        }, self.bot)
+        await self._run("click", main.button_callback, update)
+
+    async def inline(self, user_id, text):
+        """Consulta inline tecleada letra a letra: una consulta por tecla, como envía Telegram"""
+        tasks = []
+        for end in range(1, len(text) + 1):
+            update = Update.de_json({
+                "update_id": next(self._update_ids),
+                "inline_query": {"id": str(next(self._update_ids)), "from": self._user(user_id),
+                                 "query": text[:end], "offset": ""}
+            }, self.bot)
+            tasks.append(asyncio.create_task(self._run("inline", main.inline_query, update)))
+            await asyncio.sleep(KEYSTROKE_INTERVAL)
+        await asyncio.gather(*tasks)
+
+    async def _run(self, kind, handler, update):
+        started = time.perf_counter()
+        await handler(update, self.context)
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    async def replay(self, events, concurrency):
+        """Reproduce los eventos: en orden dentro de cada chat, en paralelo entre chats"""
+        by_chat = defaultdict(list)
+        for event in events:
+            by_chat[event.get("chat", 1)].append(event)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_chat(chat_id, chat_events):
+            async with semaphore:
+                for event in chat_events:
+                    if "click" in event:
+                        await self.click(chat_id, event["click"])
+                    elif "inline" in event:
+                        await self.inline(chat_id, event["inline"])
+                    else:
+                        await self.message(chat_id, event["text"], event.get("group", False))
+
+        await asyncio.gather(*(run_chat(chat_id, chat_events) for chat_id, chat_events in by_chat.items()))
+
+
+def typo(text, rng):
+    """Introduce una errata (letra cambiada, quitada o duplicada)"""
+    if len(text) < 4:
+        return text
+    position = rng.randrange(1, len(text) - 1)
+    kind = rng.choice(("swap", "drop", "double"))
+    if kind == "swap":
+        return text[:position - 1] + text[position] + text[position - 1] + text[position + 1:]
+    if kind == "drop":
+        return text[:position] + text[position + 1:]
+    return text[:position] + text[position] + text[position:]
+
+
+def synthetic_mix(users, queries, groups, seed):
+    """Mezcla de uso realista: búsquedas (a veces con erratas) seguidas de 1-3 botones"""
+    rng = random.Random(seed)
+    # Unos pocos títulos concentran la mayoría de las consultas
+    weights = [1 / rank for rank in range(1, len(CATALOG_TITLES) + 1)]
+    events = []
+    for user in range(1, users + 1):
+        for _ in range(queries):
+            title = rng.choices(CATALOG_TITLES, weights)[0][0]
+            events.append({"chat": user, "text": typo(title, rng) if rng.random() < 0.3 else title})
+            for action in rng.sample(ACTIONS, rng.randint(1, 3)):
+                events.append({"chat": user, "click": action})
+    for group in range(1, groups + 1):
+        for _ in range(queries):
+            if rng.random() < 0.7:
+                text = rng.choice(GROUP_CHATTER)
+            else:
+                text = rng.choices(CATALOG_TITLES, weights)[0][0]
+            events.append({"chat": -group, "text": text, "group": True})
+    return events
+
+
+def load_events(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(driver, upstreams, bot, elapsed):
+    updates = sum(len(samples) for samples in driver.latencies.values())
+    report = {
+        "updates": updates,
+        "elapsed": elapsed,
+        "updates_per_sec": updates / elapsed if elapsed else 0.0,
+        "upstream_calls": dict(upstreams.calls),
+        "upstream_errors": dict(upstreams.errors),
+        "upstream_calls_per_update": sum(upstreams.calls.values()) / updates if updates else 0.0,
+        "telegram_calls": dict(bot.calls),
+        "skipped_clicks": driver.skipped,
+        "latency": {}
+    }
+    every = [sample for samples in driver.latencies.values() for sample in samples]
+    for kind, samples in sorted(driver.latencies.items()) + [("all", every)]:
+        if samples:
+            report["latency"][kind] = {
+                "count": len(samples),
+                "p50": percentile(samples, 0.50),
+                "p95": percentile(samples, 0.95),
+                "p99": percentile(samples, 0.99)
+            }
+    return report
+
+
+def print_report(report, baseline=None):
+    def delta(current, previous):
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous:+.0%})"
+
+    base = baseline or {}
+    print(f"\n📊 {report['updates']} updates en {report['elapsed']:.2f}s: "
+          f"{report['updates_per_sec']:.1f} updates/s{delta(report['updates_per_sec'], base.get('updates_per_sec'))}")
+    print(f"🌐 Peticiones a las APIs: {report['upstream_calls']} "
+          f"({report['upstream_calls_per_update']:.2f} por update"
+          f"{delta(report['upstream_calls_per_update'], base.get('upstream_calls_per_update'))}), "
+          f"errores: {report['upstream_errors']}")
+    print(f"📨 Llamadas a Telegram: {report['telegram_calls']}")
+    print(f"\n{'tipo':<15}{'n':>7}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}")
+    for kind, stats in report["latency"].items():
+        previous = base.get("latency", {}).get(kind, {})
+        columns = "".join(
+            f"{stats[p] * 1000:>9.1f}{delta(stats[p], previous.get(p)):>9}" for p in ("p50", "p95", "p99")
+        )
+        print(f"{kind:<15}{stats['count']:>7}{columns}")
+
+
+async def drain_background():
+    """Espera a que terminen las precargas y peticiones compartidas pendientes"""
+    await asyncio.gather(*list(main.movie_bot._prefetch_tasks.values()), return_exceptions=True)
+    while len(main.movie_bot.inflight):
+        await asyncio.sleep(0.01)
+
+
+async def run(args):
+    catalog = FakeCatalog()
+    upstreams = FakeUpstreams(catalog, args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed)
+    await upstreams.start(BENCH_HOST, args.port)
+
+    # El bot apunta al servidor falso; sin almacén persistente para medir en frío
+    main.TMDB_BASE_URL = f"http://{BENCH_HOST}:{args.port}/tmdb"
+    main.OMDB_BASE_URL = f"http://{BENCH_HOST}:{args.port}/omdb"
+    if not args.telegram_limits:
+        # Los límites de Telegram ocultarían el coste del propio bot
+        main.TELEGRAM_PRIVATE_RATE = main.TELEGRAM_GROUP_RATE = (1e6, 1e6)
+        main.outbox.bucket = main.TokenBucket(1e6, 1e6)
+    if args.store:
+        await main.movie_bot.open_store(args.store)
+    await main.movie_bot.init_session()
+
+    bot = FakeBot(latency=args.telegram_latency / 1000)
+    await bot.initialize()
+    driver = Driver(bot)
+
+    if args.warm:
+        spent = await main.movie_bot.warm_trending()
+        print(f"🔥 Cachés precalentadas con las tendencias: {dict(spent)}")
+        upstreams.calls.clear()
+
+    if args.replay:
+        events = load_events(args.replay)
+    else:
+        events = synthetic_mix(args.users, args.queries, args.groups, args.seed)
+
+    reports = []
+    try:
+        for number in range(1, args.passes + 1):
+            driver.latencies.clear()
+            upstreams.calls.clear()
+            upstreams.errors.clear()
+            bot.calls.clear()
+            started = time.perf_counter()
+            await driver.replay(events, args.concurrency)
+            elapsed = time.perf_counter() - started
+            # Las precargas en segundo plano también cuentan como peticiones de la pasada
+            await drain_background()
+            report = summarize(driver, upstreams, bot, elapsed)
+            reports.append(report)
+            # Cada pasada se compara con la misma pasada de la referencia (fría con fría)
+            baseline = args.baseline_data["passes"][number - 1] \
+                if args.baseline_data and number <= len(args.baseline_data["passes"]) else None
+            print(f"\n===== Pasada {number} de {args.passes} =====")
+            print_report(report, baseline)
+    finally:
+        main.movie_bot.cancel_prefetches()
+        await main.movie_bot.close_store()
+        await main.movie_bot.close_session()
+        await bot.shutdown()
+        await upstreams.stop()
+
+    return reports
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline de MikalabazaBot")
+    parser.add_argument("--replay", help="fichero JSONL con los updates a reproducir")
+    parser.add_argument("--users", type=int, default=50, help="chats privados de la mezcla sintética")
+    parser.add_argument("--groups", type=int, default=5, help="grupos de la mezcla sintética")
+    parser.add_argument("--queries", type=int, default=5, help="búsquedas por chat en la mezcla sintética")
+    parser.add_argument("--concurrency", type=int, default=main.CONCURRENT_UPDATES, help="chats en paralelo")
+    parser.add_argument("--passes", type=int, default=2, help="pasadas (la primera con cachés en frío)")
+    parser.add_argument("--latency", type=float, default=80, help="latencia de las APIs falsas (ms)")
+    parser.add_argument("--jitter", type=float, default=40, help="variación aleatoria de la latencia (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracción de respuestas 503")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="latencia de la Bot API falsa (ms)")
+    parser.add_argument("--telegram-limits", action="store_true", help="respetar los límites de envío de Telegram")
+    parser.add_argument("--warm", action="store_true", help="precalentar las cachés con las tendencias antes")
+    parser.add_argument("--store", help="ruta de un almacén SQLite (por defecto, sin persistencia)")
+    parser.add_argument("--port", type=int, default=BENCH_PORT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="guardar el informe de todas las pasadas en JSON")
+    parser.add_argument("--baseline", help="informe JSON con el que comparar")
+    return parser.parse_args()
+
+
+def run_benchmark():
+    """Punto de entrada del benchmark"""
+    args = parse_args()
+    logging.getLogger("main").setLevel(logging.WARNING)
+
+    args.baseline_data = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            args.baseline_data = json.load(f)
+
+    reports = asyncio.run(run(args))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args) | {"baseline_data": None}, "passes": reports}, f, indent=2)
+        print(f"\n💾 Informe guardado en {args.save}")
+
+
+if __name__ == '__main__':
+    run_benchmark()
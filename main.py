@@ -1,12 +1,36 @@
+import abc
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
+import os
+import random
 import re
-from difflib import SequenceMatcher
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict, deque
+from dataclasses import dataclass, fields
 from datetime import datetime
 import aiohttp
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import math
+from aiohttp import web
+from telegram import (Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InputTextMessageContent)
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.ext import (Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler,
+                          filters, ContextTypes)
 
 # Configuración de logging
 logging.basicConfig(
@@ -24,97 +48,2297 @@ OMDB_API_KEY = "8db71856"
 TMDB_BASE_URL = "https://api.themoviedb.org/3"
 OMDB_BASE_URL = "http://www.omdbapi.com"
 TMDB_IMAGE_BASE = "https://image.tmdb.org/t/p/w500"
+TMDB_THUMB_BASE = "https://image.tmdb.org/t/p/w92"
+
+# Conexiones HTTP con las APIs (pool compartido y timeouts por servicio, en segundos)
+HTTP_POOL_LIMIT = 100                    # conexiones abiertas en total
+HTTP_POOL_LIMIT_PER_HOST = 20            # conexiones por host
+HTTP_KEEPALIVE_TIMEOUT = 30              # segundos que se mantiene viva una conexión libre
+HTTP_DNS_CACHE_TTL = 300                 # segundos de caché DNS
+UPSTREAM_TIMEOUTS = {
+    "tmdb": {"total": 8, "connect": 3, "sock_read": 6},
+    "omdb": {"total": 6, "connect": 3, "sock_read": 5}
+}
+
+# Modo de funcionamiento: "polling" o "webhook" (servidor aiohttp propio)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")            # URL pública registrada en Telegram
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8080"))
+# Obligatorio en modo webhook y el mismo en todos los workers (A-Z, a-z, 0-9, _ y -)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Solo hace falta que un worker registre el webhook en Telegram
+WEBHOOK_REGISTER = os.environ.get("WEBHOOK_REGISTER", "1") == "1"
+# Varios procesos pueden escuchar en el mismo puerto (el kernel reparte las conexiones)
+WEBHOOK_REUSE_PORT = os.environ.get("WEBHOOK_REUSE_PORT", "1") == "1"
+WEBHOOK_MAX_CONNECTIONS = 40
+# Solo los tipos de update que manejamos
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Modo inline (@bot título): autocompletado mientras el usuario escribe
+INLINE_DEBOUNCE = 0.4                    # segundos sin teclear antes de buscar
+INLINE_MIN_QUERY = 2                     # caracteres mínimos para buscar
+INLINE_PAGE_SIZE = 10                    # resultados por página (Telegram admite hasta 50)
+INLINE_MAX_RESULTS = 50
+INLINE_MIN_SCORE = 0.2                   # similitud mínima; el usuario aún está escribiendo
+INLINE_CACHE_TIME = 300                  # segundos que Telegram guarda las respuestas
+
+# Límites de envío a Telegram (mensajes por segundo y ráfaga)
+TELEGRAM_GLOBAL_RATE = 25                # límite global (~30/s según Telegram)
+TELEGRAM_PRIVATE_RATE = (1.0, 3)         # chats privados: ~1 mensaje/s
+TELEGRAM_GROUP_RATE = (20 / 60, 5)       # grupos: ~20 mensajes/minuto
+TELEGRAM_MAX_RETRIES = 2                 # reintentos tras un RetryAfter
+CHAT_ACTION_INTERVAL = 4.0               # como mucho un "escribiendo..." por chat en este intervalo
+OUTBOX_MAX_CHATS = 10000                 # chats cuyo estado de envío se recuerda
+
+# Updates procesados a la vez (los de un mismo chat siempre en orden)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+
+# Prioridades de las peticiones a las APIs (menor número = más urgente)
+PRIORITY_INTERACTIVE = 0                 # botones de un usuario que ya está consultando
+PRIORITY_SEARCH = 1                      # búsquedas directas (privado o mención)
+PRIORITY_BACKGROUND = 2                  # precargas y detección automática en grupos
+
+# Límites por servicio: tasa (peticiones/s), ráfaga, concurrencia y cuota diaria
+UPSTREAM_LIMITS = {
+    "tmdb": {"rate": 40, "burst": 40, "concurrency": 20, "daily_limit": None},
+    "omdb": {"rate": 5, "burst": 10, "concurrency": 5, "daily_limit": 1000}
+}
+# Segundos que una petición puede esperar turno antes de rendirse, por prioridad
+UPSTREAM_WAIT_TIMEOUTS = {
+    PRIORITY_INTERACTIVE: 8,
+    PRIORITY_SEARCH: 5,
+    PRIORITY_BACKGROUND: 2
+}
+BACKGROUND_QUOTA_SHARE = 0.8             # parte de la cuota diaria usable en segundo plano
+
+# Resiliencia: reintentos, petición duplicada (hedging) y cortacircuitos por servicio
+UPSTREAM_RETRIES = 2                     # reintentos tras errores de red, 5xx o 429
+RETRY_BASE_DELAY = 0.25                  # segundos; crece exponencialmente con jitter
+RETRY_MAX_DELAY = 3.0
+HEDGE_UPSTREAMS = {"tmdb"}               # OMDB no: su cuota diaria es pequeña
+HEDGE_PERCENTILE = 0.95                  # se duplica la petición si tarda más que este percentil
+HEDGE_MIN_DELAY = 0.3                    # segundos
+HEDGE_MIN_SAMPLES = 20                   # latencias medidas antes de empezar a duplicar
+BREAKER_FAILURE_THRESHOLD = 5            # fallos seguidos que abren el cortacircuitos
+BREAKER_RESET_TIMEOUT = 30               # segundos hasta volver a probar el servicio
+STALE_MAX_AGE = 7 * 24 * 60 * 60         # antigüedad máxima de datos expirados servidos si la API cae
+
+# Caché de detalles de TMDB (se reutiliza al cambiar entre botones)
+DETAILS_CACHE_TTL = 6 * 60 * 60          # segundos
+DETAILS_CACHE_MAX_ITEMS = 2000
+DETAILS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Caché de búsquedas (las búsquedas sin resultados se guardan menos tiempo)
+SEARCH_CACHE_TTL = 60 * 60
+SEARCH_CACHE_NEGATIVE_TTL = 10 * 60
+SEARCH_CACHE_MAX_ITEMS = 5000
+SEARCH_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Caché de OMDB
+OMDB_CACHE_TTL = 24 * 60 * 60
+OMDB_CACHE_MAX_ITEMS = 2000
+OMDB_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Correspondencia TMDB -> IMDb (no cambia, se guarda mucho tiempo)
+IMDB_ID_CACHE_TTL = 30 * 24 * 60 * 60
+IMDB_ID_CACHE_MAX_ITEMS = 50000
+
+# file_id de los pósters ya subidos a Telegram (se reutilizan en lugar de la URL)
+POSTER_FILE_ID_TTL = 30 * 24 * 60 * 60
+POSTER_FILE_ID_MAX_ITEMS = 20000
+
+# Caché de mensajes ya formateados (texto + teclado) por sección
+RENDER_CACHE_TTL = 60 * 60
+RENDER_CACHE_MAX_ITEMS = 5000
+RENDER_ACTIONS = ("basic", "ratings", "cast", "watch")
+
+# Almacén de segundo nivel detrás de las cachés en memoria:
+# "sqlite" (fichero compartido por todos los workers del nodo) o "memory" (solo este proceso)
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite")
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "mikalabaza_cache.db")  # vacío para desactivarlo
+STORE_MAX_ROWS = 20000                   # tamaño máximo tras compactar
+STORE_WARM_ROWS = 2000                   # entradas más usadas que se cargan al iniciar
+STORE_MAINTENANCE_INTERVAL = 15 * 60     # segundos entre compactaciones
+STORE_BUSY_TIMEOUT = 5.0                 # segundos esperando a que otro proceso termine de escribir
+LEASE_TTL = 10                           # segundos que un worker se reserva una petición a la API
+LEASE_WAIT = 3.0                         # segundos que los demás esperan ese resultado antes de pedirlo ellos
+LEASE_POLL_MIN = 0.05                    # intervalo inicial de consulta mientras se espera (se duplica)
+LEASE_POLL_MAX = 0.4
+
+# Índice local de títulos (trigramas) para búsquedas con errores
+TITLE_INDEX_MAX_TITLES = 300000
+TITLE_DUMP_PATH = os.environ.get("TITLE_DUMP_PATH", "")  # export diario de TMDB (JSON por línea)
+TITLE_ALIASES_MAX = 10                   # títulos alternativos por título
+MATCH_MIN_SCORE = 0.5                    # similitud mínima para preferir un resultado
+LOCAL_MATCH_SCORE = 0.72                 # similitud para resolver sin llamar a TMDB
+VARIANT_BUDGET = 6                       # búsquedas alternativas simultáneas si la consulta falla
+LEADING_ARTICLES = frozenset("el la los las lo un una unos unas the a an".split())
+
+# Pre-filtro de mensajes de grupo antes de buscar en TMDB
+TITLE_TOKENS_CAPACITY = 1000000          # palabras de títulos en el filtro de Bloom
+TITLE_TOKENS_ERROR_RATE = 0.01
+PREFILTER_MIN_KNOWN_TOKENS = 2000        # con menos palabras conocidas el filtro de Bloom no decide
+PREFILTER_MIN_KNOWN_RATIO = 0.5          # parte de las palabras que deben aparecer en títulos
+PREFILTER_MAX_WORDS = 8                  # las frases largas son conversación, no títulos
+GROUP_SEARCH_COOLDOWN = 15               # segundos entre búsquedas automáticas en un grupo
+STOPWORDS = frozenset("""
+    a al algo alguien ahi aqui asi aun bien bueno cada casi como con contra cual cuando de del desde
+    donde dos e el ella ellas ellos en entre era eres es esa ese eso esta estas este esto estoy fue
+    gracias ha hay hola hoy igual jaja jajaja jajajaja jeje la las le les lo los luego mal mas me mi
+    mis mucho muy nada ni no nos nosotros o ok okay otra otro para pero poco por porque pues que quien
+    se sea ser si siempre sin sobre solo son su sus tal tambien te tengo ti tu tus un una unas uno unos
+    vale vamos vos xd y ya yo
+    about all also am an and any are as at be because been but by can could did do does dont for from
+    get go going good got had has have he her here him his how i if im in is it its just know like lol
+    me my no not now of ok on or our out please really see she so some than thanks that the their them
+    then there they this to too u up us was we well were what when where which who why will with would
+    yeah yes you your
+""".split())
+
+# Precalentamiento de cachés con los títulos en tendencia de TMDB
+WARMER_ENABLED = os.environ.get("WARMER_ENABLED", "1") == "1"
+WARMER_INTERVAL = 3 * 60 * 60            # segundos entre pasadas
+WARMER_TMDB_BUDGET = int(os.environ.get("WARMER_TMDB_BUDGET", "120"))  # peticiones a TMDB por pasada
+WARMER_OMDB_BUDGET = int(os.environ.get("WARMER_OMDB_BUDGET", "40"))   # OMDB tiene poca cuota diaria
+WARMER_LISTS = ("trending/all/day", "movie/popular", "tv/popular")
+
+# Refresco en segundo plano: los datos caducados se sirven al momento y se piden de nuevo
+REFRESH_ENABLED = os.environ.get("REFRESH_ENABLED", "1") == "1"
+REFRESH_MAX_STALE = 24 * 60 * 60         # más caducado que esto ya se espera a la API
+REFRESH_INTERVAL = 60                    # segundos entre revisiones de las entradas más pedidas
+REFRESH_AHEAD = 2 * REFRESH_INTERVAL     # se refresca por adelantado lo que caduca antes de este margen
+REFRESH_MIN_HITS = 3                     # accesos recientes para merecer un refresco por adelantado
+REFRESH_BUDGET = 20                      # refrescos por adelantado por revisión como máximo
+REFRESH_CONCURRENCY = 4
+REFRESH_RETRY_DELAY = 5 * 60             # espera tras un refresco fallido de la misma entrada
+RECENT_RELEASE_DAYS = 2 * 365            # las calificaciones de estrenos recientes cambian más
+FRESHNESS_TTLS = {
+    # tipo de dato: (TTL de títulos recientes, TTL del resto)
+    "details": (DETAILS_CACHE_TTL, 3 * 24 * 60 * 60),    # créditos y votos de TMDB
+    "omdb": (12 * 60 * 60, 7 * 24 * 60 * 60)             # calificaciones de IMDb, RT y Metacritic
+}
+
+# Métricas en formato Prometheus, servidas solo en local
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))         # desactivado salvo que se indique un puerto
+METRICS_PATH = "/metrics"
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # segundos
+
+# Búsqueda de listas de títulos ("inception, goodfellas, dark")
+BATCH_MAX_ITEMS = 15                     # títulos por lista como máximo
+BATCH_MAX_LENGTH = 1000                  # caracteres de una lista
+BATCH_EDIT_INTERVAL = 1.5                # segundos mínimos entre ediciones del mensaje de progreso
+
+# Precarga de detalles y calificaciones tras una búsqueda
+PREFETCH_CONCURRENCY = 4                 # precargas simultáneas como máximo
+PREFETCH_TIMEOUT = 20                    # segundos antes de abandonar una precarga
+
+# Prioridad de las peticiones de la tarea actual (la fijan los handlers)
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_SEARCH)
+
+class UpstreamError(Exception):
+    """Error al consultar una API externa"""
+
+class UpstreamBusy(UpstreamError):
+    """La petición no se pudo atender a tiempo por los límites de la API"""
+
+class UpstreamUnavailable(UpstreamError):
+    """La API no responde, falla o tiene el cortacircuitos abierto"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def normalize_query(text):
+    """Normaliza un texto: minúsculas, sin acentos, sin signos y con espacios simples"""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def query_variants(query):
+    """Formas alternativas de una consulta: sin artículo inicial y sin letras repetidas.
+    
+    Todas van normalizadas, pero quitar solo los acentos no da una variante
+    nueva en el mismo idioma: la caché de búsquedas ya trata "Amélie" y
+    "amelie" como la misma consulta. Esa forma solo se prueba en otro idioma o tipo.
+    """
+    normalized = normalize_query(query)
+    words = normalized.split()
+    without_article = " ".join(words[1:]) if len(words) > 1 and words[0] in LEADING_ARTICLES else normalized
+    variants = [without_article, normalized]
+    # "matriix" -> "matrix", "el padrinno" -> "el padrino"
+    variants += [re.sub(r"(.)\1+", r"\1", variant) for variant in variants]
+    return list(dict.fromkeys(variant for variant in variants if len(variant) >= 2))
+
+def split_title_list(text):
+    """Separa una lista de títulos (por líneas o, si no hay saltos, por comas/punto y coma).
+    
+    Devuelve None si el texto no es una lista de al menos dos títulos.
+    """
+    separator = r"\n" if "\n" in text else r"[,;]"
+    titles = {}
+    for item in re.split(separator, text):
+        # Viñetas y numeración: "- dark", "• dark", "1. dark", "2) dark"
+        item = re.sub(r"^\s*(?:[-•*]|\d+[.)])\s*", "", item).strip()
+        if len(item) >= 2:
+            titles.setdefault(normalize_query(item), item)
+    return list(titles.values()) if len(titles) >= 2 else None
+
+def may_be_single_title(text, titles):
+    """Si una lista de dos títulos separados por coma puede ser un único título.
+    
+    "Love, Actually" o "The Good, the Bad and the Ugly" llevan coma; solo los
+    saltos de línea o tres o más elementos indican con seguridad una lista.
+    """
+    return "\n" not in text and len(titles) < 3 and len(text) <= 100
+
+def trigrams(text):
+    """Trigramas de caracteres de un texto ya normalizado"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def approx_size(obj):
+    """Estima el tamaño en memoria (bytes) de una estructura JSON o un objeto con __slots__"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += approx_size(key) + approx_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += approx_size(item)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += approx_size(getattr(obj, name, None))
+    return size
+
+# Campos de los resultados de búsqueda que se conservan en caché
+RESULT_FIELDS = ("id", "media_type", "title", "original_title", "release_date", "name",
+                 "original_name", "first_air_date", "poster_path", "popularity", "vote_average")
+
+def compact_results(results):
+    """Reduce los resultados de búsqueda de TMDB a los campos que se usan (sin personas)"""
+    return [
+        {field: result[field] for field in RESULT_FIELDS if field in result}
+        for result in results
+        if result.get("media_type") != "person"
+    ]
+
+@dataclass(slots=True)
+class TitleRecord:
+    """Proyección compacta de los detalles de TMDB: solo lo que usan los formateadores"""
+    tmdb_id: int
+    media_type: str
+    title: str = ""
+    original_title: str = ""
+    date: str = ""                 # release_date o first_air_date
+    overview: str = ""
+    genres: tuple = ()
+    runtime: int = 0               # minutos (por episodio en series)
+    seasons: int = None
+    episodes: int = None
+    vote_average: float = 0.0
+    vote_count: int = 0
+    directors: tuple = ()
+    creators: tuple = ()
+    cast: tuple = ()               # ((actor, personaje), ...)
+    imdb_id: str = ""
+    poster_path: str = ""
+    popularity: float = 0.0
+    aliases: tuple = ()            # títulos alternativos
+
+    @classmethod
+    def from_tmdb(cls, data, media_type):
+        """Construye el registro a partir de la respuesta de /movie o /tv"""
+        credits = data.get("credits") or {}
+        alternative = data.get("alternative_titles") or {}
+        aliases = (alternative.get("titles") or alternative.get("results") or [])[:TITLE_ALIASES_MAX]
+        
+        if media_type == "tv":
+            run_time = data.get("episode_run_time") or [0]
+            title, original_title = data.get("name", ""), data.get("original_name", "")
+            date, runtime = data.get("first_air_date") or "", run_time[0] or 0
+        else:
+            title, original_title = data.get("title", ""), data.get("original_title", "")
+            date, runtime = data.get("release_date") or "", data.get("runtime") or 0
+        
+        return cls(
+            tmdb_id=data["id"],
+            media_type=media_type,
+            title=title,
+            original_title=original_title,
+            date=date,
+            overview=data.get("overview") or "",
+            genres=tuple(genre["name"] for genre in data.get("genres", [])),
+            runtime=runtime,
+            seasons=data.get("number_of_seasons"),
+            episodes=data.get("number_of_episodes"),
+            vote_average=data.get("vote_average") or 0.0,
+            vote_count=data.get("vote_count") or 0,
+            directors=tuple(person["name"] for person in credits.get("crew", [])
+                            if person.get("job") == "Director")[:3],
+            creators=tuple(creator["name"] for creator in data.get("created_by", []))[:3],
+            cast=tuple((actor["name"], actor.get("character") or "") for actor in credits.get("cast", [])[:8]),
+            imdb_id=(data.get("external_ids") or {}).get("imdb_id") or data.get("imdb_id") or "",
+            poster_path=data.get("poster_path") or "",
+            popularity=data.get("popularity") or 0.0,
+            aliases=tuple(alias.get("title", "") for alias in aliases)
+        )
+
+    def to_row(self):
+        """Serialización compacta (lista de valores en el orden de los campos)"""
+        return [getattr(self, field.name) for field in fields(self)]
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls(*row)
+        record.genres = tuple(record.genres)
+        record.directors = tuple(record.directors)
+        record.creators = tuple(record.creators)
+        record.cast = tuple(tuple(actor) for actor in record.cast)
+        record.aliases = tuple(record.aliases)
+        return record
+
+@dataclass(slots=True)
+class RatingsRecord:
+    """Proyección compacta de una respuesta de OMDB"""
+    imdb_rating: str = ""
+    rotten_tomatoes: str = ""
+    metacritic: str = ""
+    omdb_type: str = ""
+    year: str = ""
+
+    @classmethod
+    def from_omdb(cls, data):
+        record = cls(omdb_type=data.get("Type") or "", year=data.get("Year") or "")
+        if data.get("imdbRating") and data["imdbRating"] != "N/A":
+            record.imdb_rating = data["imdbRating"]
+        for rating in data.get("Ratings") or []:
+            if "Rotten Tomatoes" in rating["Source"]:
+                record.rotten_tomatoes = rating["Value"]
+            elif "Metacritic" in rating["Source"]:
+                record.metacritic = rating["Value"]
+        return record
+
+    def to_row(self):
+        return [self.imdb_rating, self.rotten_tomatoes, self.metacritic, self.omdb_type, self.year]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+def encode_cached(namespace, value):
+    """Convierte un valor de caché a JSON para el almacén persistente"""
+    if namespace in ("details", "omdb"):
+        return value.to_row()
+    return value
+
+def decode_cached(namespace, raw, key=None):
+    """Reconstruye un valor de caché leído del almacén persistente"""
+    if namespace == "details":
+        # Las filas antiguas guardaban la respuesta completa de TMDB
+        return TitleRecord.from_tmdb(raw, key[1]) if isinstance(raw, dict) else TitleRecord.from_row(raw)
+    if namespace == "omdb":
+        return RatingsRecord.from_omdb(raw) if isinstance(raw, dict) else RatingsRecord.from_row(raw)
+    if namespace == "search":
+        return compact_results(raw)
+    return raw
+
+def release_age_days(date):
+    """Días desde el estreno ("2023-05-01", "2023", "2019–2021"), o None si no se sabe"""
+    if not date:
+        return None
+    if date.endswith("–"):
+        # Serie de OMDB que sigue en emisión
+        return 0
+    try:
+        released = datetime.strptime(date[:10], "%Y-%m-%d")
+    except ValueError:
+        years = re.findall(r"\d{4}", date)
+        if not years:
+            return None
+        released = datetime(int(years[-1]), 1, 1)
+    return (datetime.now() - released).days
+
+def freshness_ttl(namespace, record):
+    """TTL de un dato según su tipo y lo reciente que es el título.
+    
+    Los créditos de un título antiguo casi no cambian; los votos de un
+    estreno reciente (o de fecha desconocida) sí, y caducan antes.
+    """
+    recent_ttl, default_ttl = FRESHNESS_TTLS[namespace]
+    age = release_age_days(record.date if namespace == "details" else record.year)
+    return recent_ttl if age is None or age <= RECENT_RELEASE_DAYS else default_ttl
+
+def omdb_params(cache_key, title=None):
+    """Parámetros de OMDB para una clave de su caché (el título normalizado basta para OMDB)"""
+    if cache_key[0] == "i":
+        params = {"i": cache_key[1]}
+    else:
+        _, normalized, year, media_type = cache_key
+        params = {"t": title or normalized}
+        if year:
+            params["y"] = year
+        if media_type:
+            params["type"] = media_type
+    return dict(apikey=OMDB_API_KEY, plot="full", **params)
+
+# Sello global creciente: cada valor guardado en una caché recibe uno nuevo
+_stamps = itertools.count(1)
+
+class TTLCache:
+    """Caché en memoria con expiración (TTL), desalojo LRU y límite de memoria"""
+
+    def __init__(self, maxsize=1024, ttl=3600, max_bytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expira, tamaño, valor, sello)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        """Devuelve el valor si existe y no ha expirado"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        
+        expires_at, _, value, _ = entry
+        if expires_at <= time.monotonic():
+            # Lo expirado se conserva (hasta que lo desaloje el LRU) por si hay que servirlo obsoleto
+            self.misses += 1
+            return default
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Como get, pero sin contar el acceso ni alterar el orden LRU"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[2]
+
+    def get_stale(self, key, max_age=STALE_MAX_AGE, default=None):
+        """Devuelve el valor aunque haya expirado, si no lleva más de max_age segundos expirado"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] + max_age <= time.monotonic():
+            return default
+        return entry[2]
+
+    def ttl_left(self, key):
+        """Segundos hasta que caduque una entrada (negativo si ya caducó) o None si no está"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        return entry[0] - time.monotonic()
+
+    def version(self, key):
+        """Sello del valor vigente (cambia cada vez que se vuelve a guardar) o None"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[3]
+
+    def set(self, key, value, ttl=None):
+        """Guarda un valor, desalojando los menos usados si hace falta"""
+        size = approx_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        
+        if key in self._data:
+            self._remove(key)
+        
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + ttl, size, value, next(_stamps))
+        self._bytes += size
+        
+        while self._data and (len(self._data) > self.maxsize or
+                              (self.max_bytes and self._bytes > self.max_bytes)):
+            _, (_, old_size, _, _) = self._data.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Elimina una entrada de la caché"""
+        if key in self._data:
+            self._remove(key)
+
+    def _remove(self, key):
+        _, size, _, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """Contadores de uso de la caché"""
+        total = self.hits + self.misses
+        return {
+            "items": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0
+        }
+
+class CacheBackend(abc.ABC):
+    """Interfaz del almacén de segundo nivel que hay detrás de las cachés en memoria.
+    
+    Los valores llegan ya convertidos a JSON (encode_cached). Los almacenes
+    compartidos entre procesos (shared = True) además reparten turnos
+    (leases) para que una misma petición a la API la haga un solo worker.
+    """
+
+    shared = False
+
+    @abc.abstractmethod
+    async def get(self, namespace, key, allow_stale=False):
+        """Devuelve (valor, ttl restante) o None si no existe o expiró.
+        
+        Con allow_stale también devuelve entradas expiradas recientemente (ttl negativo).
+        """
+
+    @abc.abstractmethod
+    async def put(self, namespace, key, value, ttl):
+        """Guarda un valor con su TTL"""
+
+    @abc.abstractmethod
+    async def delete(self, namespace, key):
+        """Elimina una entrada"""
+
+    async def add_hits(self, counts):
+        """Suma accesos por (namespace, key) para priorizar la carga al iniciar"""
+
+    async def load_hot(self, limit=STORE_WARM_ROWS):
+        """Devuelve [(namespace, key, valor, ttl restante)] de las entradas vigentes más usadas"""
+        return []
+
+    async def compact(self):
+        """Elimina lo expirado y recorta el almacén; devuelve cuántas entradas quitó"""
+        return 0
+
+    async def acquire_lease(self, namespace, key, ttl=LEASE_TTL):
+        """True si este proceso debe pedir el dato; False si otro ya lo está pidiendo"""
+        return True
+
+    async def release_lease(self, namespace, key):
+        """Libera un turno que no terminó guardando un valor"""
+
+    async def close(self):
+        """Cierra el almacén"""
+
+class MemoryBackend(CacheBackend):
+    """Almacén en memoria de este proceso, para un solo worker o sin disco"""
+
+    def __init__(self, max_rows=STORE_MAX_ROWS):
+        self.max_rows = max_rows
+        self._entries = {}  # (namespace, key) -> [valor, expira (hora del reloj), visitas]
+
+    async def get(self, namespace, key, allow_stale=False):
+        entry = self._entries.get((namespace, key))
+        limit = time.time() - (STALE_MAX_AGE if allow_stale else 0)
+        if entry is None or entry[1] <= limit:
+            return None
+        return entry[0], entry[1] - time.time()
+
+    async def put(self, namespace, key, value, ttl):
+        entry = self._entries.get((namespace, key))
+        hits = entry[2] if entry else 0
+        self._entries[(namespace, key)] = [value, time.time() + ttl, hits]
+
+    async def delete(self, namespace, key):
+        self._entries.pop((namespace, key), None)
+
+    async def add_hits(self, counts):
+        for entry_key, hits in counts.items():
+            entry = self._entries.get(entry_key)
+            if entry:
+                entry[2] += hits
+
+    async def load_hot(self, limit=STORE_WARM_ROWS):
+        now = time.time()
+        alive = [(key, entry) for key, entry in self._entries.items() if entry[1] > now]
+        alive.sort(key=lambda item: item[1][2], reverse=True)
+        return [(namespace, key, value, expires_at - now)
+                for (namespace, key), (value, expires_at, _) in alive[:limit]]
+
+    async def compact(self):
+        limit = time.time() - STALE_MAX_AGE
+        removed = [key for key, entry in self._entries.items() if entry[1] <= limit]
+        for key in removed:
+            del self._entries[key]
+        
+        overflow = len(self._entries) - self.max_rows
+        if overflow > 0:
+            coldest = sorted(self._entries, key=lambda key: self._entries[key][2])[:overflow]
+            for key in coldest:
+                del self._entries[key]
+            removed += coldest
+        for entry in self._entries.values():
+            entry[2] //= 2
+        return len(removed)
+
+class MetadataStore(CacheBackend):
+    """Almacén persistente en SQLite para búsquedas, detalles y datos de OMDB.
+    
+    Todos los workers de un nodo pueden abrir el mismo fichero: en modo WAL
+    las lecturas no esperan a las escrituras de otros procesos, y la tabla
+    de turnos hace que cada dato lo pida a la API un solo worker.
+    
+    Las operaciones son bloqueantes y se ejecutan fuera del event loop con
+    asyncio.to_thread.
+    """
+
+    shared = True
+
+    def __init__(self, path, max_rows=STORE_MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        # Identifica los turnos de este proceso en el fichero compartido
+        self.owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=STORE_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_hits ON entries (hits)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _encode_key(key):
+        return json.dumps(list(key), ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _decode_key(raw):
+        return tuple(json.loads(raw))
+
+    def _get(self, namespace, key, allow_stale=False):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, self._encode_key(key))
+            ).fetchone()
+        limit = time.time() - (STALE_MAX_AGE if allow_stale else 0)
+        if row is None or row[1] <= limit:
+            return None
+        return json.loads(row[0]), row[1] - time.time()
+
+    def _put(self, namespace, key, value, ttl):
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        encoded_key = self._encode_key(key)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (namespace, encoded_key, data, time.time() + ttl)
+            )
+            # Con el valor guardado, quien esperaba el turno ya puede leerlo
+            self._conn.execute("DELETE FROM leases WHERE namespace = ? AND key = ?", (namespace, encoded_key))
+            self._conn.commit()
+
+    def _acquire_lease(self, namespace, key, ttl):
+        encoded_key = self._encode_key(key)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM leases WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                (namespace, encoded_key, now)
+            )
+            granted = self._conn.execute(
+                "INSERT OR IGNORE INTO leases (namespace, key, owner, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, encoded_key, self.owner, now + ttl)
+            ).rowcount == 1
+            self._conn.commit()
+        return granted
+
+    def _release_lease(self, namespace, key):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM leases WHERE namespace = ? AND key = ? AND owner = ?",
+                (namespace, self._encode_key(key), self.owner)
+            )
+            self._conn.commit()
+
+    def _add_hits(self, counts):
+        rows = [(hits, namespace, self._encode_key(key)) for (namespace, key), hits in counts.items()]
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE entries SET hits = hits + ? WHERE namespace = ? AND key = ?", rows
+            )
+            self._conn.commit()
+
+    def _load_hot(self, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT namespace, key, value, expires_at FROM entries "
+                "WHERE expires_at > ? ORDER BY hits DESC LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+        now = time.time()
+        return [(namespace, self._decode_key(key), json.loads(value), expires_at - now)
+                for namespace, key, value, expires_at in rows]
+
+    def _compact(self):
+        with self._lock:
+            # Lo expirado se guarda un tiempo para servirlo si la API cae
+            expired = self._conn.execute(
+                "DELETE FROM entries WHERE expires_at <= ?", (time.time() - STALE_MAX_AGE,)
+            ).rowcount
+            # Si aún sobra, se eliminan las entradas menos usadas
+            overflow = self._conn.execute(
+                "DELETE FROM entries WHERE rowid IN ("
+                " SELECT rowid FROM entries ORDER BY hits DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,)
+            ).rowcount
+            # Las visitas decaen para que lo popular de hace semanas no ocupe sitio para siempre
+            self._conn.execute("UPDATE entries SET hits = hits / 2")
+            # Turnos de workers que murieron sin liberarlos
+            self._conn.execute("DELETE FROM leases WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+        return expired + overflow
+
+    def _delete(self, namespace, key):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, self._encode_key(key))
+            )
+            self._conn.commit()
+
+    def _close(self):
+        with self._lock:
+            self._conn.close()
+
+    async def get(self, namespace, key, allow_stale=False):
+        return await asyncio.to_thread(self._get, namespace, key, allow_stale)
+
+    async def put(self, namespace, key, value, ttl):
+        await asyncio.to_thread(self._put, namespace, key, value, ttl)
+
+    async def delete(self, namespace, key):
+        await asyncio.to_thread(self._delete, namespace, key)
+
+    async def add_hits(self, counts):
+        if counts:
+            await asyncio.to_thread(self._add_hits, counts)
+
+    async def load_hot(self, limit=STORE_WARM_ROWS):
+        return await asyncio.to_thread(self._load_hot, limit)
+
+    async def compact(self):
+        return await asyncio.to_thread(self._compact)
+
+    async def acquire_lease(self, namespace, key, ttl=LEASE_TTL):
+        return await asyncio.to_thread(self._acquire_lease, namespace, key, ttl)
+
+    async def release_lease(self, namespace, key):
+        await asyncio.to_thread(self._release_lease, namespace, key)
+
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+def create_cache_backend(kind, path):
+    """Crea el almacén de segundo nivel configurado"""
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return MetadataStore(path)
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+class BloomFilter:
+    """Filtro de Bloom: pertenencia aproximada (sin falsos negativos) en poca memoria"""
+
+    def __init__(self, capacity=TITLE_TOKENS_CAPACITY, error_rate=TITLE_TOKENS_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little")
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Añade un elemento"""
+        new = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                self._bits[byte] |= 1 << bit
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                return False
+        return True
+
+class TitleEntry:
+    """Título conocido por el índice local"""
+    __slots__ = ("tmdb_id", "media_type", "title", "original_title", "date",
+                 "poster_path", "popularity", "names", "complete")
+
+    def __init__(self, tmdb_id, media_type, title, original_title="", date="",
+                 poster_path=None, popularity=0.0, complete=True):
+        self.tmdb_id = tmdb_id
+        self.media_type = media_type
+        self.title = title
+        self.original_title = original_title
+        self.date = date
+        self.poster_path = poster_path
+        self.popularity = popularity
+        self.names = set()
+        # False si solo se conoce por el volcado offline (sin fecha ni póster) o en otro idioma
+        self.complete = complete
+
+    def as_result(self):
+        """Devuelve el título con la forma de un resultado de búsqueda de TMDB"""
+        if self.media_type == "tv":
+            return {
+                "id": self.tmdb_id,
+                "media_type": "tv",
+                "name": self.title,
+                "original_name": self.original_title,
+                "first_air_date": self.date,
+                "poster_path": self.poster_path,
+                "popularity": self.popularity
+            }
+        return {
+            "id": self.tmdb_id,
+            "media_type": "movie",
+            "title": self.title,
+            "original_title": self.original_title,
+            "release_date": self.date,
+            "poster_path": self.poster_path,
+            "popularity": self.popularity
+        }
+
+class TitleIndex:
+    """Índice invertido de trigramas sobre títulos conocidos.
+    
+    Cada título se indexa por su nombre, su título original y sus títulos
+    alternativos, normalizados sin acentos. La similitud es el coeficiente de
+    Dice entre los trigramas de la consulta y los del nombre.
+    """
+
+    def __init__(self, max_titles=TITLE_INDEX_MAX_TITLES):
+        self.max_titles = max_titles
+        self._entries = {}                  # (media_type, tmdb_id) -> TitleEntry
+        self._names = []                    # name_id -> (nombre normalizado, clave, nº trigramas)
+        self._postings = defaultdict(list)  # trigrama -> [name_id]
+        self.tokens = BloomFilter()         # palabras que aparecen en algún título
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry, aliases=()):
+        """Añade o completa un título"""
+        key = (entry.media_type, entry.tmdb_id)
+        current = self._entries.get(key)
+        if current is None:
+            if len(self._entries) >= self.max_titles:
+                return
+            self._entries[key] = current = entry
+        elif entry.complete:
+            # Los datos de TMDB sustituyen a los del volcado offline
+            current.title = entry.title
+            current.original_title = entry.original_title or current.original_title
+            current.date = entry.date
+            current.poster_path = entry.poster_path
+            current.popularity = entry.popularity or current.popularity
+            current.complete = True
+        
+        for name in (entry.title, entry.original_title, *aliases):
+            normalized = normalize_query(name or "")
+            if not normalized or normalized in current.names:
+                continue
+            current.names.add(normalized)
+            for token in normalized.split():
+                self.tokens.add(token)
+            grams = trigrams(normalized)
+            name_id = len(self._names)
+            self._names.append((normalized, key, len(grams)))
+            for gram in grams:
+                self._postings[gram].append(name_id)
+
+    def add_results(self, results, language="es-ES"):
+        """Añade resultados de búsqueda de TMDB.
+        
+        Los de otro idioma solo aportan nombres para encontrar el título; el
+        nombre, la fecha y el póster que se muestran son siempre los de es-ES.
+        """
+        complete = language == "es-ES"
+        for result in results:
+            if result.get("media_type") == "person" or not result.get("id"):
+                continue
+            if result.get("media_type") == "tv" or "first_air_date" in result:
+                self.add(TitleEntry(
+                    result["id"], "tv",
+                    result.get("name", ""),
+                    result.get("original_name", ""),
+                    result.get("first_air_date") or "",
+                    result.get("poster_path"),
+                    result.get("popularity") or 0.0,
+                    complete
+                ))
+            else:
+                self.add(TitleEntry(
+                    result["id"], "movie",
+                    result.get("title", ""),
+                    result.get("original_title", ""),
+                    result.get("release_date") or "",
+                    result.get("poster_path"),
+                    result.get("popularity") or 0.0,
+                    complete
+                ))
+
+    def add_details(self, record):
+        """Añade un título a partir de sus detalles, incluidos los títulos alternativos"""
+        self.add(TitleEntry(record.tmdb_id, record.media_type, record.title, record.original_title,
+                            record.date, record.poster_path or None, record.popularity), record.aliases)
+
+    def search(self, query, limit=5, min_score=0.3):
+        """Devuelve [(similitud, TitleEntry)] ordenado de mayor a menor"""
+        normalized = normalize_query(query)
+        if not normalized:
+            return []
+        
+        grams = trigrams(normalized)
+        shared = Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings:
+                shared.update(postings)
+        
+        best = {}
+        query_size = len(grams)
+        for name_id, count in shared.items():
+            _, key, name_size = self._names[name_id]
+            score = 2 * count / (query_size + name_size)
+            if score >= min_score and score > best.get(key, 0):
+                best[key] = score
+        
+        ranked = sorted(best.items(), key=lambda item: (item[1], self._entries[item[0]].popularity), reverse=True)
+        return [(score, self._entries[key]) for key, score in ranked[:limit]]
+
+    def best(self, query, min_score=LOCAL_MATCH_SCORE):
+        """Devuelve el título más parecido si supera min_score"""
+        matches = self.search(query, limit=1, min_score=min_score)
+        return matches[0][1] if matches else None
+
+    @staticmethod
+    def read_dump(path):
+        """Lee un volcado de títulos de TMDB (JSON por línea); bloqueante"""
+        entries = []
+        with open(path, encoding="utf-8") as dump:
+            for line in dump:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if "original_name" in item:
+                    entries.append(TitleEntry(item["id"], "tv", item["original_name"], item["original_name"],
+                                              popularity=item.get("popularity") or 0.0, complete=False))
+                elif "original_title" in item:
+                    entries.append(TitleEntry(item["id"], "movie", item["original_title"], item["original_title"],
+                                              popularity=item.get("popularity") or 0.0, complete=False))
+        return entries
+
+class TokenBucket:
+    """Cubeta de tokens: `rate` peticiones por segundo con ráfagas de hasta `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, deadline=None):
+        """Reserva un token y espera a que esté disponible; UpstreamBusy si no llega antes de deadline"""
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        
+        wait = -self.tokens / self.rate
+        if deadline is not None and time.monotonic() + wait > deadline:
+            self.tokens += 1
+            raise UpstreamBusy("rate limit")
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self.tokens += 1
+            raise
+
+class PriorityLimiter:
+    """Semáforo que entrega los permisos libres primero a la prioridad más alta"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = []  # heap de (prioridad, orden de llegada, future)
+        self._order = itertools.count()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, priority, timeout):
+        """Espera un permiso; UpstreamBusy si no llega en `timeout` segundos"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamBusy("too many concurrent requests") from None
+        except asyncio.CancelledError:
+            # Si el permiso llegó justo al cancelarse, se devuelve
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Libera un permiso, pasándolo directamente al siguiente en espera"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+class UpstreamGovernor:
+    """Controla tasa, concurrencia y cuota diaria de las peticiones a una API"""
+
+    def __init__(self, name, rate, burst, concurrency, daily_limit=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = PriorityLimiter(concurrency)
+        self.daily_limit = daily_limit
+        self.used_today = 0
+        self._day = time.strftime("%Y-%m-%d", time.gmtime())
+        self.rejected = 0
+
+    def _check_quota(self, priority):
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        if today != self._day:
+            self._day = today
+            self.used_today = 0
+        if not self.daily_limit:
+            return
+        
+        limit = self.daily_limit
+        if priority >= PRIORITY_BACKGROUND:
+            # Se reserva parte de la cuota para las consultas de los usuarios
+            limit = int(limit * BACKGROUND_QUOTA_SHARE)
+        if self.used_today >= limit:
+            raise UpstreamBusy(f"{self.name} daily quota exhausted")
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority):
+        """Turno para hacer una petición; lanza UpstreamBusy si no llega a tiempo"""
+        timeout = UPSTREAM_WAIT_TIMEOUTS.get(priority, UPSTREAM_WAIT_TIMEOUTS[PRIORITY_BACKGROUND])
+        deadline = time.monotonic() + timeout
+        try:
+            self._check_quota(priority)
+            await self.limiter.acquire(priority, timeout)
+        except UpstreamBusy:
+            self.rejected += 1
+            raise
+        
+        try:
+            try:
+                await self.bucket.acquire(deadline)
+            except UpstreamBusy:
+                self.rejected += 1
+                raise
+            self.used_today += 1
+            yield
+        finally:
+            self.limiter.release()
+
+class CircuitBreaker:
+    """Corta las peticiones a un servicio que falla seguido y lo vuelve a probar pasado un tiempo"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        """True si se puede intentar una petición"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        
+        # Medio abierto: una sola petición de prueba a la vez
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release(self):
+        """La petición permitida no llegó a salir (p. ej. por falta de turno)"""
+        self._probing = False
+
+    def success(self):
+        if self.state != "closed":
+            logger.info(f"Circuit breaker for {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class SingleFlight:
+    """Agrupa llamadas concurrentes con la misma clave en una sola petición"""
+
+    def __init__(self):
+        self._inflight = {}
+        self._waiters = Counter()  # tarea compartida -> llamadores esperando
+        self._priorities = {}      # tarea compartida -> prioridad de quien la lanzó
+        self.coalesced = 0
+        self.abandoned = 0
+        self.overtaken = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, func, *args):
+        """Ejecuta func(*args) una sola vez por clave; el resto espera el mismo resultado.
+        
+        La tarea compartida hereda la prioridad de quien la lanzó. Un llamador más
+        urgente no se une a una de menos prioridad (p. ej. una precarga), que
+        esperaría turno tras todo lo demás y con menos paciencia: lanza la suya,
+        y los siguientes llamadores se unen a esa.
+        """
+        priority = request_priority.get()
+        task = self._inflight.get(key)
+        if task is not None and self._priorities[task] > priority:
+            self.overtaken += 1
+            task = None
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._inflight[key] = task
+            self._priorities[task] = priority
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        
+        # shield: si un llamador se cancela, la petición compartida sigue para los demás;
+        # si se cancelan todos (p. ej. consultas inline ya superadas), se cancela también
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                task.cancel()
+                self.abandoned += 1
+                # La tarea puede tardar en terminar: un llamador nuevo no debe unirse a ella
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        del self._priorities[task]
+        # Evita avisos de "exception was never retrieved" si todos se cancelaron
+        if not task.cancelled():
+            task.exception()
+
+class Metrics:
+    """Registro de métricas en memoria con salida en el formato de texto de Prometheus.
+    
+    Contadores e histogramas se actualizan en el camino caliente sin formatear
+    nada; los valores instantáneos (cachés, colas) se leen de los colectores
+    solo cuando alguien consulta el endpoint.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = defaultdict(float)  # (nombre, etiquetas) -> valor
+        self._histograms = {}                # (nombre, etiquetas) -> [cuentas por cubeta, suma]
+        self._collectors = []                # funciones que devuelven [(nombre, tipo, etiquetas, valor)]
+        self._runner = None
+
+    def inc(self, name, value=1, **labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+
+    def collector(self, func):
+        """Registra una función que se evalúa en cada consulta del endpoint"""
+        self._collectors.append(func)
+        return func
+
+    def timed(self, handler_name):
+        """Decorador que mide la duración de un handler"""
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(*args, **kwargs):
+                started = time.monotonic()
+                try:
+                    return await handler(*args, **kwargs)
+                finally:
+                    self.observe("mikalabaza_handler_seconds", time.monotonic() - started, handler=handler_name)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+    def render(self):
+        """Texto de exposición de Prometheus con todas las métricas"""
+        samples = defaultdict(list)  # nombre -> [(sufijo, etiquetas, valor)]
+        types = {}
+        
+        for (name, labels), value in self._counters.items():
+            types[name] = "counter"
+            samples[name].append(("", labels, value))
+        
+        for (name, labels), (counts, total) in self._histograms.items():
+            types[name] = "histogram"
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples[name].append(("_bucket", labels + (("le", le),), cumulative))
+            samples[name].append(("_sum", labels, total))
+            samples[name].append(("_count", labels, cumulative))
+        
+        for collect in self._collectors:
+            try:
+                collected = collect()
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {e}")
+                continue
+            for name, kind, labels, value in collected:
+                types[name] = kind
+                samples[name].append(("", tuple(sorted(labels.items())), value))
+        
+        lines = []
+        for name in sorted(samples):
+            lines.append(f"# TYPE {name} {types[name]}")
+            for suffix, labels, value in samples[name]:
+                lines.append(f"{name}{suffix}{self._labels(labels)} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self, host, port):
+        """Expone las métricas en http://host:port/metrics"""
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                                headers={"X-Content-Type-Options": "nosniff"})
+        
+        app = web.Application()
+        app.router.add_get(METRICS_PATH, handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            # Con varios workers solo el primero consigue el puerto
+            logger.warning(f"Metrics endpoint disabled, cannot listen on {host}:{port}: {e}")
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info(f"Metrics endpoint listening on {host}:{port}{METRICS_PATH}")
+
+    async def stop_server(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
 
 class MovieBot:
     def __init__(self):
         self.session = None
+        self.details_cache = TTLCache(
+            maxsize=DETAILS_CACHE_MAX_ITEMS,
+            ttl=DETAILS_CACHE_TTL,
+            max_bytes=DETAILS_CACHE_MAX_BYTES
+        )
+        self.search_cache = TTLCache(
+            maxsize=SEARCH_CACHE_MAX_ITEMS,
+            ttl=SEARCH_CACHE_TTL,
+            max_bytes=SEARCH_CACHE_MAX_BYTES
+        )
+        self.omdb_cache = TTLCache(
+            maxsize=OMDB_CACHE_MAX_ITEMS,
+            ttl=OMDB_CACHE_TTL,
+            max_bytes=OMDB_CACHE_MAX_BYTES
+        )
+        self.imdb_ids = TTLCache(
+            maxsize=IMDB_ID_CACHE_MAX_ITEMS,
+            ttl=IMDB_ID_CACHE_TTL
+        )
+        self.render_cache = TTLCache(
+            maxsize=RENDER_CACHE_MAX_ITEMS,
+            ttl=RENDER_CACHE_TTL
+        )
+        self.poster_file_ids = TTLCache(
+            maxsize=POSTER_FILE_ID_MAX_ITEMS,
+            ttl=POSTER_FILE_ID_TTL
+        )
+        self.caches = {
+            "search": self.search_cache,
+            "details": self.details_cache,
+            "omdb": self.omdb_cache,
+            "imdb": self.imdb_ids,
+            "poster": self.poster_file_ids
+        }
+        self.inflight = SingleFlight()
+        self.governors = {
+            name: UpstreamGovernor(name, **limits) for name, limits in UPSTREAM_LIMITS.items()
+        }
+        self.breakers = {name: CircuitBreaker(name) for name in UPSTREAM_LIMITS}
+        self.latencies = {name: deque(maxlen=200) for name in UPSTREAM_LIMITS}
+        self.resilience_stats = Counter()  # reintentos, hedges y datos obsoletos servidos
+        self.title_index = TitleIndex()
+        self.store = None
+        self._store_hits = Counter()
+        self._maintenance_task = None
+        self._background = set()
+        self._prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        self._prefetch_tasks = {}  # chat_id -> tarea de precarga
+        self._warmer_task = None
+        self.warmer_stats = Counter()      # peticiones hechas por el precalentador, por servicio
+        self._leases = {}                  # (namespace, key) reservada en el almacén -> versión al reservarla
+        self._access = Counter()           # (namespace, key) -> accesos recientes a detalles y OMDB
+        self.refreshing = {}               # (namespace, key) -> tarea de refresco en curso
+        self._refresh_after = {}           # (namespace, key) -> instante a partir del que se reintenta
+        self._refresh_semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+        self._refresher_task = None
+    
+    async def open_store(self, path, backend=CACHE_BACKEND):
+        """Abre el almacén de segundo nivel y carga en memoria las entradas más usadas"""
+        try:
+            self.store = await asyncio.to_thread(create_cache_backend, backend, path)
+            rows = await self.store.load_hot()
+        except Exception as e:
+            logger.error(f"Error opening cache store {path}: {e}")
+            self.store = None
+            return
+        
+        for namespace, key, raw, ttl in rows:
+            if namespace not in self.caches:
+                continue
+            value = decode_cached(namespace, raw, key)
+            self.caches[namespace].set(key, value, ttl=ttl)
+            if namespace == "search":
+                self.title_index.add_results(value, key[2])
+            elif namespace == "details":
+                self.title_index.add_details(value)
+        logger.info(f"Cache store {path} opened, {len(rows)} entries loaded")
+        
+        self._maintenance_task = asyncio.create_task(self._store_maintenance())
+    
+    async def load_title_dump(self, path):
+        """Carga en el índice local un volcado offline de títulos"""
+        try:
+            entries = await asyncio.to_thread(TitleIndex.read_dump, path)
+        except Exception as e:
+            logger.error(f"Error reading title dump {path}: {e}")
+            return
+        
+        for i, entry in enumerate(entries):
+            self.title_index.add(entry)
+            # Cede el event loop de vez en cuando en volcados grandes
+            if i % 5000 == 0:
+                await asyncio.sleep(0)
+        logger.info(f"Title index loaded {len(entries)} titles from {path}")
+    
+    async def close_store(self):
+        """Guarda los contadores pendientes y cierra el almacén"""
+        if not self.store:
+            return
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        try:
+            await self._flush_store_hits()
+            await self.store.close()
+        except Exception as e:
+            logger.error(f"Error closing cache store: {e}")
+        self.store = None
+    
+    async def _store_maintenance(self):
+        """Tarea periódica: guarda contadores de uso y compacta el almacén"""
+        while True:
+            await asyncio.sleep(STORE_MAINTENANCE_INTERVAL)
+            try:
+                await self._flush_store_hits()
+                removed = await self.store.compact()
+                logger.info(f"Cache store compacted, {removed} entries removed")
+            except Exception as e:
+                logger.error(f"Error in cache store maintenance: {e}")
+    
+    async def _flush_store_hits(self):
+        counts, self._store_hits = self._store_hits, Counter()
+        await self.store.add_hits(counts)
+    
+    def _spawn(self, coro):
+        """Lanza una tarea en segundo plano manteniendo una referencia"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+    
+    def _cache_get(self, namespace, key):
+        """Busca en memoria y cuenta el acceso para el almacén persistente"""
+        value = self.caches[namespace].get(key)
+        if value is not None and self.store:
+            self._store_hits[(namespace, key)] += 1
+        return value
+    
+    def _count_use(self, namespace, key):
+        """Cuenta el uso de una entrada servida sin pasar por _cache_get"""
+        if REFRESH_ENABLED:
+            self._access[(namespace, key)] += 1
+        if self.store:
+            self._store_hits[(namespace, key)] += 1
+    
+    async def _store_get(self, namespace, key):
+        """Busca en el almacén persistente y, si existe, lo sube a memoria"""
+        if not self.store:
+            return None
+        try:
+            row = await self.store.get(namespace, key)
+        except Exception as e:
+            logger.error(f"Error reading cache store: {e}")
+            return None
+        if row is None:
+            return None
+        
+        raw, ttl = row
+        value = decode_cached(namespace, raw, key)
+        self.caches[namespace].set(key, value, ttl=ttl)
+        self._store_hits[(namespace, key)] += 1
+        return value
+    
+    async def _claim(self, namespace, key):
+        """Turno entre procesos para pedir un dato a la API.
+        
+        Devuelve None si este proceso debe hacer la petición, o el valor que
+        otro worker dejó en el almacén compartido mientras se esperaba.
+        """
+        if not self.store or not self.store.shared:
+            return None
+        
+        deadline = time.monotonic() + LEASE_WAIT
+        delay = LEASE_POLL_MIN
+        try:
+            while not await self.store.acquire_lease(namespace, key):
+                if time.monotonic() >= deadline:
+                    # El otro worker tarda demasiado: se pide sin turno
+                    return None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LEASE_POLL_MAX)
+                value = await self._store_get(namespace, key)
+                if value is not None:
+                    self.resilience_stats["peer_fetches"] += 1
+                    return value
+        except Exception as e:
+            logger.error(f"Error claiming cache lease: {e}")
+            return None
+        
+        self._leases[(namespace, key)] = self.caches[namespace].version(key)
+        return None
+    
+    async def _claim_refresh(self, namespace, key):
+        """Turno entre procesos para refrescar por adelantado una entrada aún vigente.
+        
+        Devuelve None si este proceso debe pedirla a la API, o el valor vigente:
+        el que otro worker ya refrescó en el almacén o, si tarda demasiado en
+        hacerlo, el que hay en memoria.
+        """
+        if not self.store or not self.store.shared:
+            return None
+        
+        deadline = time.monotonic() + LEASE_WAIT
+        delay = LEASE_POLL_MIN
+        try:
+            while not await self.store.acquire_lease(namespace, key):
+                if time.monotonic() >= deadline:
+                    return self.caches[namespace].peek(key)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LEASE_POLL_MAX)
+                value = await self._refreshed_by_peer(namespace, key)
+                if value is not None:
+                    return value
+            # Otro worker pudo terminar justo antes de que se obtuviera el turno
+            value = await self._refreshed_by_peer(namespace, key)
+            if value is not None:
+                await self.store.release_lease(namespace, key)
+                return value
+        except Exception as e:
+            logger.error(f"Error claiming cache lease: {e}")
+            return None
+        
+        self._leases[(namespace, key)] = self.caches[namespace].version(key)
+        return None
+    
+    async def _refreshed_by_peer(self, namespace, key):
+        """Fila del almacén que otro worker ya refrescó (no caduca pronto), subida a memoria"""
+        row = await self.store.get(namespace, key)
+        if row is None or row[1] <= REFRESH_AHEAD:
+            return None
+        raw, ttl = row
+        value = decode_cached(namespace, raw, key)
+        self.caches[namespace].set(key, value, ttl=ttl)
+        self.resilience_stats["peer_fetches"] += 1
+        return value
+    
+    def _release_claim(self, namespace, key):
+        """Libera el turno si la petición terminó sin guardar nada (al guardar se libera solo)"""
+        if (namespace, key) not in self._leases:
+            return
+        claimed_version = self._leases.pop((namespace, key))
+        if self.caches[namespace].version(key) == claimed_version:
+            self._spawn(self._release_lease(namespace, key))
+    
+    async def _release_lease(self, namespace, key):
+        try:
+            await self.store.release_lease(namespace, key)
+        except Exception as e:
+            logger.error(f"Error releasing cache lease: {e}")
+    
+    def _cache_put(self, namespace, key, value, ttl=None):
+        """Guarda en memoria y, en segundo plano, en el almacén persistente"""
+        cache = self.caches[namespace]
+        ttl = cache.ttl if ttl is None else ttl
+        cache.set(key, value, ttl=ttl)
+        if self.store:
+            self._spawn(self._store_put(namespace, key, value, ttl))
+    
+    def _cache_delete(self, namespace, key):
+        """Elimina una entrada de memoria y del almacén persistente"""
+        self.caches[namespace].invalidate(key)
+        if self.store:
+            self._spawn(self.store.delete(namespace, key))
+    
+    def get_poster_file_id(self, poster_path):
+        """file_id de Telegram de un póster ya enviado, si se conoce"""
+        return self._cache_get("poster", (poster_path,))
+    
+    def remember_poster(self, poster_path, file_id):
+        """Guarda el file_id que Telegram asignó a un póster"""
+        self._cache_put("poster", (poster_path,), file_id)
+    
+    def forget_poster(self, poster_path):
+        """Descarta un file_id que Telegram ya no acepta"""
+        self._cache_delete("poster", (poster_path,))
+    
+    async def _store_put(self, namespace, key, value, ttl):
+        try:
+            await self.store.put(namespace, key, encode_cached(namespace, value), ttl)
+        except Exception as e:
+            logger.error(f"Error writing cache store: {e}")
     
     async def init_session(self):
-        """Inicializa la sesión HTTP"""
+        """Inicializa la sesión HTTP con un pool de conexiones limitado y DNS en caché"""
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(**UPSTREAM_TIMEOUTS["tmdb"])
+            )
     
     async def close_session(self):
         """Cierra la sesión HTTP"""
         if self.session:
             await self.session.close()
+            self.session = None
     
-    def similarity(self, a, b):
-        """Calcula similitud entre dos strings"""
-        return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+    async def _get_json(self, upstream, url, params):
+        """GET a una API externa con reintentos, hedging y cortacircuitos.
+        
+        Devuelve el JSON de la respuesta, o None si el servicio contesta con un
+        error definitivo (404, 401...). Lanza UpstreamBusy si no hay turno en el
+        limitador y UpstreamUnavailable si el servicio no responde o el
+        cortacircuitos está abierto.
+        """
+        breaker = self.breakers[upstream]
+        if not breaker.allow():
+            raise UpstreamUnavailable(f"{upstream} circuit open")
+        
+        try:
+            data = await self._get_json_with_retries(upstream, url, params)
+        except UpstreamUnavailable:
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        
+        breaker.success()
+        return data
+    
+    async def _get_json_with_retries(self, upstream, url, params):
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            try:
+                return await self._hedged_get(upstream, url, params)
+            except UpstreamUnavailable as e:
+                if attempt == UPSTREAM_RETRIES:
+                    raise
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.5)
+                if e.retry_after is not None:
+                    if e.retry_after > RETRY_MAX_DELAY:
+                        raise
+                    delay = max(delay, e.retry_after)
+                logger.warning(f"{e}; retrying in {delay:.2f}s")
+                self.resilience_stats[f"{upstream}_retries"] += 1
+                await asyncio.sleep(delay)
+    
+    def _hedge_delay(self, upstream):
+        """Segundos tras los que se lanza una segunda petición, o None si no se duplica"""
+        if upstream not in HEDGE_UPSTREAMS or request_priority.get() >= PRIORITY_BACKGROUND:
+            return None
+        samples = self.latencies[upstream]
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return max(HEDGE_MIN_DELAY, ordered[int(HEDGE_PERCENTILE * (len(ordered) - 1))])
+    
+    async def _hedged_get(self, upstream, url, params):
+        """Si la petición tarda más de lo habitual, lanza otra igual y se queda con la primera que responda"""
+        delay = self._hedge_delay(upstream)
+        if delay is None:
+            return await self._single_get(upstream, url, params)
+        
+        tasks = {asyncio.ensure_future(self._single_get(upstream, url, params))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.resilience_stats[f"{upstream}_hedges"] += 1
+                tasks.add(asyncio.ensure_future(self._single_get(upstream, url, params)))
+            
+            pending = tasks
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
     
-    async def search_tmdb(self, query, media_type="multi"):
-        """Busca en TMDB con tolerancia a errores"""
+    async def _single_get(self, upstream, url, params):
+        """Una petición GET con los timeouts del servicio, esperando turno en su limitador"""
         await self.init_session()
         
+        timeout = aiohttp.ClientTimeout(**UPSTREAM_TIMEOUTS[upstream])
+        async with self.governors[upstream].slot(request_priority.get()):
+            started = time.monotonic()
+            status = "error"
+            try:
+                async with self.session.get(url, params=params, timeout=timeout) as response:
+                    status = str(response.status)
+                    if response.status == 200:
+                        data = await response.json()
+                        self.latencies[upstream].append(time.monotonic() - started)
+                        return data
+                    
+                    if response.status == 429 or response.status >= 500:
+                        retry_after = response.headers.get("Retry-After", "")
+                        raise UpstreamUnavailable(
+                            f"{upstream} returned HTTP {response.status}",
+                            retry_after=float(retry_after) if retry_after.isdigit() else None
+                        )
+                    
+                    logger.warning(f"{upstream} returned HTTP {response.status}")
+                    return None
+            except asyncio.TimeoutError as e:
+                status = "timeout"
+                raise UpstreamUnavailable(f"{upstream} request failed: {e!r}") from e
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            except aiohttp.ClientError as e:
+                raise UpstreamUnavailable(f"{upstream} request failed: {e!r}") from e
+            finally:
+                metrics.observe("mikalabaza_upstream_request_seconds", time.monotonic() - started, upstream=upstream)
+                metrics.inc("mikalabaza_upstream_requests_total", upstream=upstream, status=status)
+    
+    def _cached_or_stale(self, namespace, key):
+        """Valor en memoria; si caducó hace poco, se sirve igual y se refresca en segundo plano"""
+        if not REFRESH_ENABLED:
+            return self._cache_get(namespace, key)
+        self._access[(namespace, key)] += 1
+        value = self._cache_get(namespace, key)
+        if value is None:
+            value = self.caches[namespace].get_stale(key, max_age=REFRESH_MAX_STALE)
+            if value is not None:
+                self.resilience_stats["stale_while_revalidate"] += 1
+                self.schedule_refresh(namespace, key)
+        return value
+    
+    def schedule_refresh(self, namespace, key):
+        """Vuelve a pedir una entrada en segundo plano; False si ya está en curso o falló hace poco"""
+        item = (namespace, key)
+        if item in self.refreshing or self._refresh_after.get(item, 0) > time.monotonic():
+            return False
+        task = asyncio.create_task(self._refresh(namespace, key))
+        self.refreshing[item] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(item, None))
+        return True
+    
+    async def _refresh(self, namespace, key):
+        request_priority.set(PRIORITY_BACKGROUND)
+        cache = self.caches[namespace]
+        before = cache.version(key)
+        async with self._refresh_semaphore:
+            # Si aún no caducó es un refresco por adelantado: el almacén tendría la misma copia
+            refresh = before is not None
+            try:
+                if namespace == "details":
+                    tmdb_id, media_type, language = key
+                    await self.inflight.do(("details",) + key, self._fetch_details,
+                                           tmdb_id, media_type, language, key, refresh)
+                else:
+                    await self.inflight.do(("omdb",) + key, self._fetch_omdb, omdb_params(key), key, refresh)
+            except Exception as e:
+                logger.debug("Refresh of %s %s failed: %s", namespace, key, e)
+        
+        version = cache.version(key)
+        if version is None or version == before:
+            # Se sigue sirviendo lo que había; se reintenta más tarde
+            self._refresh_after[(namespace, key)] = time.monotonic() + REFRESH_RETRY_DELAY
+            self.resilience_stats["refresh_failures"] += 1
+        else:
+            self.resilience_stats["refreshes"] += 1
+    
+    def start_refresher(self):
+        """Arranca la tarea periódica que refresca por adelantado las entradas más pedidas"""
+        if self._refresher_task is None:
+            self._refresher_task = asyncio.create_task(self._refresher_loop())
+    
+    def stop_refresher(self):
+        if self._refresher_task:
+            self._refresher_task.cancel()
+            self._refresher_task = None
+        for task in list(self.refreshing.values()):
+            task.cancel()
+    
+    async def _refresher_loop(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            try:
+                scheduled = self.refresh_hot_entries()
+                if scheduled:
+                    logger.debug("Scheduled %s refreshes ahead of expiry", scheduled)
+            except Exception as e:
+                logger.error(f"Error scheduling cache refreshes: {e}")
+    
+    def refresh_hot_entries(self, budget=REFRESH_BUDGET):
+        """Refresca, de más a menos pedidas, las entradas que caducarán pronto.
+        
+        Los contadores de acceso se reducen a la mitad en cada revisión, así
+        que el orden refleja el uso reciente y las entradas frías se olvidan.
+        """
+        hot = sorted(
+            ((count, item) for item, count in self._access.items() if count >= REFRESH_MIN_HITS),
+            key=lambda entry: entry[0], reverse=True
+        )
+        scheduled = 0
+        for _, (namespace, key) in hot:
+            if scheduled >= budget:
+                break
+            left = self.caches[namespace].ttl_left(key)
+            if left is None or left > REFRESH_AHEAD or left < -REFRESH_MAX_STALE:
+                continue
+            if self.schedule_refresh(namespace, key):
+                scheduled += 1
+        
+        self._access = Counter({item: count // 2 for item, count in self._access.items() if count > 1})
+        now = time.monotonic()
+        self._refresh_after = {item: after for item, after in self._refresh_after.items() if after > now}
+        return scheduled
+    
+    async def _stale_get(self, namespace, key):
+        """Último valor conocido aunque haya expirado, para cuando la API no responde"""
+        value = self.caches[namespace].get_stale(key)
+        if value is None and self.store:
+            try:
+                row = await self.store.get(namespace, key, allow_stale=True)
+            except Exception as e:
+                logger.error(f"Error reading cache store: {e}")
+                row = None
+            if row:
+                value = decode_cached(namespace, row[0], key)
+        if value is not None:
+            self.resilience_stats["stale_served"] += 1
+        return value
+    
+    def similarity(self, a, b):
+        """Calcula similitud entre dos strings (Dice sobre trigramas, sin acentos)"""
+        grams_a = trigrams(normalize_query(a))
+        grams_b = trigrams(normalize_query(b))
+        return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+    
+    async def search_tmdb(self, query, media_type="multi", language="es-ES"):
+        """Busca en TMDB con tolerancia a errores (con caché por consulta normalizada)"""
+        cache_key = (normalize_query(query), media_type, language)
+        cached = self._cache_get("search", cache_key)
+        if cached is not None:
+            return cached
+        
+        return await self.inflight.do(("search",) + cache_key, self._fetch_search, query, media_type, language, cache_key)
+    
+    async def _fetch_search(self, query, media_type, language, cache_key):
+        """Petición de búsqueda a TMDB"""
+        stored = await self._store_get("search", cache_key)
+        if stored is None:
+            stored = await self._claim("search", cache_key)
+        if stored is not None:
+            self.title_index.add_results(stored, language)
+            return stored
+        
         url = f"{TMDB_BASE_URL}/search/{media_type}"
         params = {
             "api_key": TMDB_API_KEY,
             "query": query,
-            "language": "es-ES"
+            "language": language
         }
         
         try:
-            async with self.session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("results", [])
+            data = await self._get_json("tmdb", url, params)
+            if data is not None:
+                results = compact_results(data.get("results", []))
+                # Los resultados vacíos se guardan menos tiempo
+                ttl = SEARCH_CACHE_TTL if results else SEARCH_CACHE_NEGATIVE_TTL
+                self._cache_put("search", cache_key, results, ttl=ttl)
+                self.title_index.add_results(results, language)
+                return results
+        except UpstreamError as e:
+            stale = await self._stale_get("search", cache_key)
+            if stale is None:
+                raise
+            logger.warning(f"Serving stale search for '{query}': {e}")
+            return stale
         except Exception as e:
             logger.error(f"Error searching TMDB: {e}")
+        finally:
+            self._release_claim("search", cache_key)
         
         return []
     
-    async def get_tmdb_details(self, tmdb_id, media_type):
-        """Obtiene detalles completos de TMDB"""
-        await self.init_session()
+    async def get_tmdb_details(self, tmdb_id, media_type, language="es-ES"):
+        """Obtiene detalles completos de TMDB (con caché en memoria)"""
+        cache_key = (int(tmdb_id), media_type, language)
+        cached = self._cached_or_stale("details", cache_key)
+        if cached is not None:
+            return cached
+        
+        return await self.inflight.do(("details",) + cache_key, self._fetch_details, tmdb_id, media_type, language, cache_key)
+    
+    async def _fetch_details(self, tmdb_id, media_type, language, cache_key, refresh=False):
+        """Petición de detalles a TMDB (refresh: refresco por adelantado de una entrada aún vigente)"""
+        if refresh:
+            stored = await self._claim_refresh("details", cache_key)
+        else:
+            stored = await self._store_get("details", cache_key)
+            if stored is None:
+                stored = await self._claim("details", cache_key)
+        if stored is not None:
+            self.title_index.add_details(stored)
+            self._remember_imdb_id(stored)
+            return stored
         
         url = f"{TMDB_BASE_URL}/{media_type}/{tmdb_id}"
         params = {
             "api_key": TMDB_API_KEY,
-            "language": "es-ES",
-            "append_to_response": "credits,videos,external_ids"
+            "language": language,
+            "append_to_response": "credits,videos,external_ids,alternative_titles"
         }
         
         try:
-            async with self.session.get(url, params=params) as response:
-                if response.status == 200:
-                    return await response.json()
+            data = await self._get_json("tmdb", url, params)
+            if data is not None:
+                # Solo se guarda en caché la proyección compacta, no la respuesta completa
+                record = TitleRecord.from_tmdb(data, media_type)
+                self._cache_put("details", cache_key, record, ttl=freshness_ttl("details", record))
+                self.title_index.add_details(record)
+                self._remember_imdb_id(record)
+                return record
+        except UpstreamError as e:
+            stale = await self._stale_get("details", cache_key)
+            if stale is None:
+                raise
+            logger.warning(f"Serving stale details for {media_type} ID {tmdb_id}: {e}")
+            return stale
         except Exception as e:
             logger.error(f"Error getting TMDB details: {e}")
+        finally:
+            self._release_claim("details", cache_key)
         
         return None
     
-    async def search_omdb(self, title, year=None, media_type=None):
-        """Busca en OMDB"""
-        await self.init_session()
+    def _remember_imdb_id(self, record):
+        """Guarda el id de IMDb de un título para consultar OMDB sin esperar a TMDB"""
+        key = (record.tmdb_id, record.media_type)
+        if record.imdb_id and self.imdb_ids.get(key) != record.imdb_id:
+            self._cache_put("imdb", key, record.imdb_id)
+    
+    async def get_omdb_by_imdb(self, imdb_id):
+        """Busca en OMDB por id de IMDb (con caché)"""
+        cache_key = ("i", imdb_id)
+        cached = self._cached_or_stale("omdb", cache_key)
+        if cached is not None:
+            return cached
         
-        params = {
-            "apikey": OMDB_API_KEY,
-            "t": title,
-            "plot": "full"
-        }
+        return await self.inflight.do(("omdb",) + cache_key, self._fetch_omdb, omdb_params(cache_key), cache_key)
+    
+    async def search_omdb(self, title, year=None, media_type=None):
+        """Busca en OMDB (con caché)"""
+        cache_key = ("t", normalize_query(title), year, media_type)
+        cached = self._cached_or_stale("omdb", cache_key)
+        if cached is not None:
+            return cached
         
-        if year:
-            params["y"] = year
-        if media_type:
-            params["type"] = media_type
+        return await self.inflight.do(("omdb",) + cache_key, self._fetch_omdb, omdb_params(cache_key, title), cache_key)
+    
+    async def _fetch_omdb(self, params, cache_key, refresh=False):
+        """Petición a OMDB (refresh: refresco por adelantado de una entrada aún vigente)"""
+        if refresh:
+            stored = await self._claim_refresh("omdb", cache_key)
+        else:
+            stored = await self._store_get("omdb", cache_key)
+            if stored is None:
+                stored = await self._claim("omdb", cache_key)
+        if stored is not None:
+            return stored
         
         try:
-            async with self.session.get(OMDB_BASE_URL, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("Response") == "True":
-                        return data
+            data = await self._get_json("omdb", OMDB_BASE_URL, params)
+            if data and data.get("Response") == "True":
+                record = RatingsRecord.from_omdb(data)
+                self._cache_put("omdb", cache_key, record, ttl=freshness_ttl("omdb", record))
+                return record
+        except UpstreamError as e:
+            stale = await self._stale_get("omdb", cache_key)
+            if stale is None:
+                raise
+            logger.warning(f"Serving stale OMDB data for {cache_key}: {e}")
+            return stale
         except Exception as e:
             logger.error(f"Error searching OMDB: {e}")
+        finally:
+            self._release_claim("omdb", cache_key)
         
         return None
     
-    def find_best_match(self, query, results):
-        """Encuentra la mejor coincidencia considerando errores tipográficos"""
-        if not results:
+    async def get_omdb_for_details(self, tmdb_details, media_type):
+        """Obtiene los datos de OMDB correspondientes a unos detalles de TMDB"""
+        if tmdb_details.imdb_id:
+            return await self.get_omdb_by_imdb(tmdb_details.imdb_id)
+        
+        # Sin id de IMDb se busca por título; el original funciona mejor que el traducido
+        title = tmdb_details.original_title or tmdb_details.title
+        if not title:
+            return None
+        
+        year = tmdb_details.date[:4] or None
+        return await self.search_omdb(title, year, "movie" if media_type == "movie" else "series")
+    
+    async def get_ratings_data(self, tmdb_id, media_type):
+        """Obtiene detalles de TMDB y datos de OMDB en paralelo si ya se conoce el id de IMDb"""
+        imdb_id = self._cache_get("imdb", (int(tmdb_id), media_type))
+        if imdb_id:
+            tmdb_details, omdb_data = await asyncio.gather(
+                self.get_tmdb_details(tmdb_id, media_type),
+                self.get_omdb_by_imdb(imdb_id),
+                return_exceptions=True
+            )
+            if isinstance(tmdb_details, BaseException):
+                raise tmdb_details
+        else:
+            tmdb_details = await self.get_tmdb_details(tmdb_id, media_type)
+            if not tmdb_details:
+                return None, None
+            try:
+                omdb_data = await self.get_omdb_for_details(tmdb_details, media_type)
+            except UpstreamError as e:
+                omdb_data = e
+        
+        if isinstance(omdb_data, BaseException):
+            # Sin OMDB se muestran al menos las calificaciones de TMDB
+            if not isinstance(omdb_data, UpstreamError):
+                raise omdb_data
+            logger.warning(f"OMDB skipped for {media_type} ID {tmdb_id}: {omdb_data}")
+            omdb_data = None
+        return tmdb_details, omdb_data
+    
+    def _render_version(self, action, tmdb_id, media_type):
+        """Versión de los datos de los que depende una sección, o None si no están en caché"""
+        details_version = self.details_cache.version((tmdb_id, media_type, "es-ES"))
+        if details_version is None:
+            return None
+        if action != "ratings":
+            return (details_version,)
+        
+        imdb_id = self.imdb_ids.peek((tmdb_id, media_type))
+        omdb_version = self.omdb_cache.version(("i", imdb_id)) if imdb_id else None
+        if omdb_version is None:
+            return None
+        return (details_version, omdb_version)
+    
+    async def render(self, action, tmdb_id, media_type):
+        """Devuelve (texto, teclado) de una sección o None si no hay detalles.
+        
+        El resultado se reutiliza mientras los datos en caché de los que depende
+        no se vuelvan a descargar.
+        """
+        version = self._render_version(action, tmdb_id, media_type)
+        if version is not None:
+            cached = self.render_cache.get((tmdb_id, media_type, action, version))
+            if cached is not None:
+                # Los datos de los que depende cuentan como usados aunque no se lean
+                self._count_use("details", (tmdb_id, media_type, "es-ES"))
+                if action == "ratings":
+                    self._count_use("omdb", ("i", self.imdb_ids.peek((tmdb_id, media_type))))
+                return cached
+        
+        omdb_data = None
+        if action == "ratings":
+            # Detalles y datos de OMDB (calificaciones adicionales) a la vez
+            tmdb_details, omdb_data = await self.get_ratings_data(tmdb_id, media_type)
+        else:
+            tmdb_details = await self.get_tmdb_details(tmdb_id, media_type)
+        
+        if not tmdb_details:
             return None
         
+        # Generar contenido según la acción
+        if action == "basic":
+            content = self.format_basic_info(tmdb_details, omdb_data)
+        elif action == "ratings":
+            content = self.format_ratings(tmdb_details, omdb_data)
+        elif action == "cast":
+            content = self.format_cast_crew(tmdb_details)
+        elif action == "watch":
+            content = self.format_where_to_watch(tmdb_details, omdb_data)
+        else:
+            content = "❌ Acción no reconocida."
+            logger.error(f"Unknown action: {action}")
+        
+        keyboard = create_info_keyboard({'id': tmdb_id, 'media_type': tmdb_details.media_type})
+        rendered = (content, keyboard)
+        
+        version = self._render_version(action, tmdb_id, media_type)
+        if version is not None and action in RENDER_ACTIONS:
+            self.render_cache.set((tmdb_id, media_type, action, version), rendered)
+        return rendered
+    
+    def prefetch(self, tmdb_id, media_type, chat_id):
+        """Precarga en segundo plano detalles y OMDB del título mostrado en un chat.
+        
+        Una búsqueda nueva en el mismo chat cancela la precarga anterior, que ya
+        no es útil.
+        """
+        previous = self._prefetch_tasks.pop(chat_id, None)
+        if previous and not previous.done():
+            previous.cancel()
+        
+        task = asyncio.create_task(self._prefetch(tmdb_id, media_type))
+        self._prefetch_tasks[chat_id] = task
+        task.add_done_callback(lambda t: self._prefetch_done(chat_id, t))
+        return task
+    
+    def _prefetch_done(self, chat_id, task):
+        if self._prefetch_tasks.get(chat_id) is task:
+            del self._prefetch_tasks[chat_id]
+    
+    async def _prefetch(self, tmdb_id, media_type):
+        # Las precargas ceden el paso a las consultas de los usuarios
+        request_priority.set(PRIORITY_BACKGROUND)
+        async with self._prefetch_semaphore:
+            try:
+                await asyncio.wait_for(self._prefetch_title(tmdb_id, media_type), PREFETCH_TIMEOUT)
+            except (asyncio.TimeoutError, UpstreamError):
+                logger.debug("Prefetch skipped for %s ID %s", media_type, tmdb_id)
+            except Exception as e:
+                logger.error(f"Error prefetching {media_type} ID {tmdb_id}: {e}")
+    
+    async def _prefetch_title(self, tmdb_id, media_type):
+        details = await self.get_tmdb_details(tmdb_id, media_type)
+        if details:
+            await self.get_omdb_for_details(details, media_type)
+    
+    def start_warmer(self):
+        """Arranca la tarea periódica que precalienta las cachés con las tendencias"""
+        if self._warmer_task is None:
+            self._warmer_task = asyncio.create_task(self._warmer_loop())
+    
+    def stop_warmer(self):
+        if self._warmer_task:
+            self._warmer_task.cancel()
+            self._warmer_task = None
+    
+    async def _warmer_loop(self):
+        while True:
+            try:
+                await self.warm_trending()
+            except Exception as e:
+                logger.error(f"Error warming caches: {e}")
+            await asyncio.sleep(WARMER_INTERVAL)
+    
+    async def warm_trending(self, tmdb_budget=WARMER_TMDB_BUDGET, omdb_budget=WARMER_OMDB_BUDGET):
+        """Precarga búsqueda, detalles, OMDB e índice local de los títulos en tendencia.
+        
+        Los títulos se recorren de más a menos populares hasta agotar el
+        presupuesto de peticiones; lo que ya está en caché no gasta presupuesto.
+        """
+        request_priority.set(PRIORITY_BACKGROUND)
+        spent = Counter()
+        titles = {}
+        try:
+            for path in WARMER_LISTS:
+                if spent["tmdb"] >= tmdb_budget:
+                    break
+                spent["tmdb"] += 1
+                for result in await self._fetch_list(path):
+                    titles.setdefault((result["media_type"], result["id"]), result)
+            
+            ranked = sorted(titles.values(), key=lambda r: r.get("popularity") or 0.0, reverse=True)
+            for result in ranked:
+                if spent["tmdb"] >= tmdb_budget:
+                    break
+                await self._warm_title(result, spent, tmdb_budget, omdb_budget)
+        except UpstreamError as e:
+            logger.warning(f"Cache warming stopped early: {e}")
+        finally:
+            self.warmer_stats.update(spent)
+        logger.info(f"Cache warming done: {len(titles)} trending titles, "
+                    f"{spent['tmdb']} TMDB and {spent['omdb']} OMDB requests")
+        return spent
+    
+    async def _fetch_list(self, path):
+        """Una lista de TMDB (tendencias, populares) como resultados de búsqueda compactos"""
+        data = await self._get_json("tmdb", f"{TMDB_BASE_URL}/{path}", {
+            "api_key": TMDB_API_KEY,
+            "language": "es-ES"
+        })
+        results = compact_results((data or {}).get("results", []))
+        # Las listas por tipo ("movie/popular") no incluyen media_type
+        list_type = path.split("/")[0]
+        for result in results:
+            if "media_type" not in result and list_type in ("movie", "tv"):
+                result["media_type"] = list_type
+        results = [result for result in results if result.get("media_type") in ("movie", "tv")]
+        self.title_index.add_results(results)
+        return results
+    
+    async def _warm_title(self, result, spent, tmdb_budget, omdb_budget):
+        tmdb_id, media_type = result["id"], result["media_type"]
+        
+        # La búsqueda por el título mostrado, tal como la escribiría un usuario
+        title = result.get("title") or result.get("name")
+        if title and self.search_cache.peek((normalize_query(title), "multi", "es-ES")) is None:
+            spent["tmdb"] += 1
+            await self.search_tmdb(title)
+        
+        if spent["tmdb"] >= tmdb_budget:
+            return
+        if self.details_cache.peek((tmdb_id, media_type, "es-ES")) is None:
+            spent["tmdb"] += 1
+        details = await self.get_tmdb_details(tmdb_id, media_type)
+        if not details or spent["omdb"] >= omdb_budget:
+            return
+        
+        if not details.imdb_id or self.omdb_cache.peek(("i", details.imdb_id)) is None:
+            spent["omdb"] += 1
+        try:
+            await self.get_omdb_for_details(details, media_type)
+        except UpstreamError as e:
+            # Sin OMDB se sigue calentando lo de TMDB
+            logger.debug("OMDB warming skipped for %s ID %s: %s", media_type, tmdb_id, e)
+    
+    def cancel_prefetches(self):
+        """Cancela las precargas pendientes"""
+        for task in self._prefetch_tasks.values():
+            task.cancel()
+        self._prefetch_tasks.clear()
+    
+    def score_results(self, query, results):
+        """Devuelve (similitud, resultado) del resultado más parecido a la consulta"""
         best_match = None
         best_score = 0
         
@@ -136,31 +2360,166 @@ class MovieBot:
                 best_score = max_score
                 best_match = result
         
-        # Solo devolver si la similitud es razonable (>0.6)
-        return best_match if best_score > 0.6 else results[0]
+        return best_score, best_match
+    
+    def is_single_title(self, text, parts, match):
+        """Si una coincidencia corresponde al texto completo ("Love, Actually") y no a una de sus partes"""
+        if not match:
+            return False
+        score, _ = self.score_results(text, [match])
+        return score > MATCH_MIN_SCORE and all(score >= self.score_results(part, [match])[0] for part in parts)
+    
+    async def find_title(self, query, fan_out=True):
+        """Resuelve una consulta: primero en el índice local y, si no basta, en TMDB.
+        
+        Con fan_out=False no se prueban variantes de la consulta si falla.
+        """
+        local = self.title_index.best(query)
+        if local and local.complete:
+            return local.as_result()
+        
+        # Si el índice reconoce el título (p. ej. por el volcado offline), se busca
+        # el nombre corregido en lugar del texto con erratas
+        results = await self.search_tmdb(local.title if local else query)
+        if not results and local:
+            results = await self.search_tmdb(query)
+        
+        score, match = self.score_results(query, results)
+        if score > MATCH_MIN_SCORE:
+            return match
+        
+        # Sin una coincidencia clara se prueban variantes de la consulta a la vez.
+        # La detección automática en grupos no merece el gasto.
+        if fan_out and request_priority.get() < PRIORITY_BACKGROUND:
+            variant_score, variant_match = await self.search_variants(query)
+            if variant_score > MATCH_MIN_SCORE or (variant_match and not results):
+                return variant_match
+        
+        return results[0] if results else None
+    
+    def _variant_searches(self, query):
+        """(texto, tipo, idioma) a probar, de más a menos prometedor, sin repetir la consulta original"""
+        variants = query_variants(query)
+        if not variants:
+            return []
+        searches = [(variant, "multi", "es-ES") for variant in variants]
+        searches += [(variants[0], "multi", "en-US")]
+        searches += [(variant, media_type, "es-ES") for variant in variants[:1] for media_type in ("movie", "tv")]
+        searches += [(variant, "multi", "en-US") for variant in variants[1:]]
+        
+        original = normalize_query(query)
+        unique = dict.fromkeys(
+            search for search in searches if (normalize_query(search[0]), search[1], search[2]) != (original, "multi", "es-ES")
+        )
+        return list(unique)[:VARIANT_BUDGET]
+    
+    async def search_variants(self, query):
+        """Busca variantes de la consulta en paralelo y se queda con la primera coincidencia clara.
+        
+        Devuelve (similitud, resultado); el resto de búsquedas se cancelan en
+        cuanto una supera MATCH_MIN_SCORE.
+        """
+        tasks = [
+            asyncio.ensure_future(self._score_variant(query, text, media_type, language))
+            for text, media_type, language in self._variant_searches(query)
+        ]
+        best = (0, None)
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    score, match = await next_done
+                except UpstreamError:
+                    continue
+                if score > best[0]:
+                    best = (score, match)
+                if score > MATCH_MIN_SCORE:
+                    self.resilience_stats["variant_matches"] += 1
+                    break
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        return best
+    
+    async def _score_variant(self, query, text, media_type, language):
+        results = await self.search_tmdb(text, media_type, language)
+        if media_type != "multi":
+            # /search/movie y /search/tv no indican el tipo en cada resultado
+            results = [dict(result, media_type=media_type) for result in results]
+        best = self.score_results(query, results)
+        if text != query:
+            best = max(best, self.score_results(text, results), key=lambda pair: pair[0])
+        return best
+    
+    async def autocomplete(self, query, limit=INLINE_MAX_RESULTS):
+        """Resultados para el modo inline, de más a menos parecidos a la consulta.
+        
+        Se usan el índice local y la caché de búsquedas; TMDB solo se consulta
+        si el índice no tiene suficientes candidatos buenos.
+        """
+        candidates = {}
+        for score, entry in self.title_index.search(query, limit=limit, min_score=INLINE_MIN_SCORE):
+            candidates[(entry.media_type, entry.tmdb_id)] = (score, entry.popularity, entry.as_result())
+        
+        good = sum(1 for score, _, _ in candidates.values() if score >= LOCAL_MATCH_SCORE)
+        results = self._cache_get("search", (normalize_query(query), "multi", "es-ES"))
+        if results is None and good < INLINE_PAGE_SIZE:
+            try:
+                results = await self.search_tmdb(query)
+            except UpstreamError as e:
+                logger.warning(f"Inline search for '{query}' served from local index: {e}")
+        
+        for result in results or []:
+            if result.get("media_type") not in ("movie", "tv"):
+                continue
+            title, original_title = (
+                (result.get("name", ""), result.get("original_name", "")) if result["media_type"] == "tv"
+                else (result.get("title", ""), result.get("original_title", ""))
+            )
+            score = max(self.similarity(query, title), self.similarity(query, original_title or title))
+            key = (result["media_type"], result["id"])
+            if score >= candidates.get(key, (0,))[0]:
+                candidates[key] = (score, result.get("popularity") or 0.0, result)
+        
+        ranked = sorted(candidates.values(), key=lambda c: (c[0], c[1]), reverse=True)
+        return [result for _, _, result in ranked[:limit]]
+    
+    def format_summary(self, tmdb_data, omdb_data=None):
+        """Una línea con título, año y calificaciones, para las listas"""
+        icon = "📺" if tmdb_data.media_type == "tv" else "🎬"
+        text = f"{icon} *{escape_markdown(tmdb_data.title)}*"
+        if tmdb_data.date:
+            text += f" ({tmdb_data.date[:4]})"
+        
+        ratings = []
+        if tmdb_data.vote_average:
+            ratings.append(f"🟢 {tmdb_data.vote_average:.1f}")
+        if omdb_data and omdb_data.imdb_rating:
+            ratings.append(f"🟡 {omdb_data.imdb_rating}")
+        if omdb_data and omdb_data.rotten_tomatoes:
+            ratings.append(f"🍅 {omdb_data.rotten_tomatoes}")
+        if ratings:
+            text += " — " + " · ".join(ratings)
+        return text
     
     def format_basic_info(self, tmdb_data, omdb_data=None):
         """Formatea información básica"""
-        if tmdb_data.get("media_type") == "tv" or tmdb_data.get("first_air_date"):
+        title = tmdb_data.title or "N/A"
+        original_title = tmdb_data.original_title
+        year = tmdb_data.date[:4] or "N/A"
+        if tmdb_data.media_type == "tv":
             # Es una serie
-            title = tmdb_data.get("name", "N/A")
-            original_title = tmdb_data.get("original_name", "")
-            year = tmdb_data.get("first_air_date", "")[:4] if tmdb_data.get("first_air_date") else "N/A"
-            runtime = f"{tmdb_data.get('episode_run_time', [45])[0]} min/episodio" if tmdb_data.get('episode_run_time') else "N/A"
-            status = tmdb_data.get("status", "N/A")
-            seasons = tmdb_data.get("number_of_seasons", "N/A")
-            episodes = tmdb_data.get("number_of_episodes", "N/A")
+            runtime = f"{tmdb_data.runtime} min/episodio" if tmdb_data.runtime else "N/A"
+            seasons = tmdb_data.seasons if tmdb_data.seasons is not None else "N/A"
+            episodes = tmdb_data.episodes if tmdb_data.episodes is not None else "N/A"
             type_info = f"📺 Serie TV • {seasons} temporada(s) • {episodes} episodios"
         else:
             # Es una película
-            title = tmdb_data.get("title", "N/A")
-            original_title = tmdb_data.get("original_title", "")
-            year = tmdb_data.get("release_date", "")[:4] if tmdb_data.get("release_date") else "N/A"
-            runtime = f"{tmdb_data.get('runtime', 'N/A')} min" if tmdb_data.get('runtime') else "N/A"
+            runtime = f"{tmdb_data.runtime} min" if tmdb_data.runtime else "N/A"
             type_info = "🎬 Película"
         
-        genres = ", ".join([g["name"] for g in tmdb_data.get("genres", [])])
-        overview = tmdb_data.get("overview", "No disponible")
+        genres = ", ".join(tmdb_data.genres)
+        overview = tmdb_data.overview or "No disponible"
         
         text = f"🎭 **{title}** ({year})\n"
         if original_title and original_title != title:
@@ -177,24 +2536,17 @@ class MovieBot:
         text = "⭐ **CALIFICACIONES**\n\n"
         
         # TMDB
-        if tmdb_data.get("vote_average"):
-            tmdb_rating = tmdb_data["vote_average"]
-            tmdb_votes = tmdb_data.get("vote_count", 0)
-            text += f"🟢 **TMDB:** {tmdb_rating}/10 ({tmdb_votes:,} votos)\n"
+        if tmdb_data.vote_average:
+            text += f"🟢 **TMDB:** {tmdb_data.vote_average}/10 ({tmdb_data.vote_count:,} votos)\n"
         
         # OMDB ratings
         if omdb_data:
-            if omdb_data.get("imdbRating") and omdb_data["imdbRating"] != "N/A":
-                text += f"🟡 **IMDb:** {omdb_data['imdbRating']}/10\n"
-            
-            if omdb_data.get("Ratings"):
-                for rating in omdb_data["Ratings"]:
-                    source = rating["Source"]
-                    value = rating["Value"]
-                    if "Rotten Tomatoes" in source:
-                        text += f"🍅 **Rotten Tomatoes:** {value}\n"
-                    elif "Metacritic" in source:
-                        text += f"🎯 **Metacritic:** {value}\n"
+            if omdb_data.imdb_rating:
+                text += f"🟡 **IMDb:** {omdb_data.imdb_rating}/10\n"
+            if omdb_data.rotten_tomatoes:
+                text += f"🍅 **Rotten Tomatoes:** {omdb_data.rotten_tomatoes}\n"
+            if omdb_data.metacritic:
+                text += f"🎯 **Metacritic:** {omdb_data.metacritic}\n"
         
         return text if len(text) > len("⭐ **CALIFICACIONES**\n\n") else "⭐ No se encontraron calificaciones disponibles."
     
@@ -202,29 +2554,20 @@ class MovieBot:
         """Formatea reparto y equipo"""
         text = "🎭 **REPARTO Y EQUIPO**\n\n"
         
-        credits = tmdb_data.get("credits", {})
-        
         # Director (solo para películas)
-        if tmdb_data.get("media_type") != "tv" and not tmdb_data.get("first_air_date"):
-            crew = credits.get("crew", [])
-            directors = [person["name"] for person in crew if person["job"] == "Director"]
-            if directors:
-                text += f"🎬 **Director(es):** {', '.join(directors[:3])}\n\n"
-        else:
+        if tmdb_data.media_type != "tv":
+            if tmdb_data.directors:
+                text += f"🎬 **Director(es):** {', '.join(tmdb_data.directors)}\n\n"
+        elif tmdb_data.creators:
             # Para series, mostrar creadores
-            creators = tmdb_data.get("created_by", [])
-            if creators:
-                creator_names = [creator["name"] for creator in creators]
-                text += f"👨‍💼 **Creador(es):** {', '.join(creator_names[:3])}\n\n"
+            text += f"👨‍💼 **Creador(es):** {', '.join(tmdb_data.creators)}\n\n"
         
         # Actores principales
-        cast = credits.get("cast", [])
-        if cast:
+        if tmdb_data.cast:
             text += "🎭 **Actores principales:**\n"
-            for actor in cast[:8]:
-                character = actor.get("character", "")
+            for name, character in tmdb_data.cast:
                 char_text = f" como {character}" if character else ""
-                text += f"• {actor['name']}{char_text}\n"
+                text += f"• {name}{char_text}\n"
         
         return text if len(text) > len("🎭 **REPARTO Y EQUIPO**\n\n") else "🎭 No se encontró información del reparto."
     
@@ -233,8 +2576,8 @@ class MovieBot:
         text = "📺 **DÓNDE VER**\n\n"
         
         # Información básica de disponibilidad
-        if omdb_data and omdb_data.get("Type"):
-            media_type = "película" if omdb_data["Type"] == "movie" else "serie"
+        if omdb_data and omdb_data.omdb_type:
+            media_type = "película" if omdb_data.omdb_type == "movie" else "serie"
             text += f"🎬 Busca esta {media_type} en:\n"
         
         text += "🔍 **Plataformas sugeridas:**\n"
@@ -242,9 +2585,8 @@ class MovieBot:
         text += "\n💡 **Tip:** Usa JustWatch.com para verificar disponibilidad en tu región"
         
         # Si hay información del año, agregar contexto
-        if tmdb_data.get("release_date") or tmdb_data.get("first_air_date"):
-            date_field = "release_date" if tmdb_data.get("release_date") else "first_air_date"
-            year = tmdb_data[date_field][:4]
+        if tmdb_data.date:
+            year = tmdb_data.date[:4]
             current_year = datetime.now().year
             
             if int(year) >= current_year - 2:
@@ -252,9 +2594,273 @@ class MovieBot:
         
         return text
 
+class GroupMessageFilter:
+    """Pre-filtro local que decide si un mensaje de grupo merece una búsqueda.
+    
+    Descarta frases largas, mensajes hechos solo de palabras vacías, textos
+    cuyas palabras no aparecen en ningún título conocido y búsquedas
+    demasiado seguidas en el mismo grupo. Cuenta cuántas búsquedas se ahorra.
+    """
+
+    def __init__(self, title_index):
+        self.title_index = title_index
+        self._last_search = OrderedDict()  # chat_id -> última búsqueda automática
+        self.allowed = 0
+        self.saved = Counter()             # motivo -> búsquedas evitadas
+
+    def check(self, chat_id, text):
+        """Devuelve True si el mensaje puede ser un título y debe buscarse"""
+        reason = self._reject_reason(chat_id, text)
+        if reason:
+            self.saved[reason] += 1
+            return False
+        
+        self._last_search[chat_id] = time.monotonic()
+        self._last_search.move_to_end(chat_id)
+        if len(self._last_search) > OUTBOX_MAX_CHATS:
+            self._last_search.popitem(last=False)
+        self.allowed += 1
+        return True
+
+    def _reject_reason(self, chat_id, text):
+        words = normalize_query(text).split()
+        if len(words) > PREFILTER_MAX_WORDS:
+            return "too_long"
+        
+        content = [word for word in words if word not in STOPWORDS]
+        if not content:
+            return "stopwords"
+        
+        # Solo se confía en el filtro de Bloom cuando ya conoce bastantes títulos
+        tokens = self.title_index.tokens
+        if tokens.count >= PREFILTER_MIN_KNOWN_TOKENS:
+            known = sum(1 for word in content if word in tokens)
+            if known / len(content) < PREFILTER_MIN_KNOWN_RATIO:
+                return "unknown_words"
+        
+        last = self._last_search.get(chat_id)
+        if last is not None and time.monotonic() - last < GROUP_SEARCH_COOLDOWN:
+            return "cooldown"
+        return None
+
+class ChatLocks:
+    """Serializa los handlers por chat: con updates concurrentes, los de un
+    mismo chat se siguen procesando en el orden en que llegaron"""
+
+    def __init__(self):
+        self._locks = {}  # chat_id -> [lock, tareas que lo usan]
+
+    @property
+    def waiting(self):
+        """Updates esperando a que termine otro del mismo chat"""
+        return sum(users - 1 for _, users in self._locks.values())
+
+    def serialized(self, handler):
+        """Decorador para handlers de python-telegram-bot"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            chat = update.effective_chat
+            if chat is None:
+                return await handler(update, context)
+            
+            entry = self._locks.get(chat.id)
+            if entry is None:
+                entry = self._locks[chat.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    return await handler(update, context)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[chat.id]
+        
+        return wrapper
+
+class TelegramOutbox:
+    """Programa los envíos a Telegram respetando los límites por chat y globales.
+    
+    Cada chat tiene su propia cubeta de tokens; un RetryAfter solo frena al
+    chat que lo recibió. Las acciones de chat repetidas ("escribiendo...") se
+    descartan.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._lanes = OrderedDict()       # chat_id -> [lock, cubeta, bloqueado hasta]
+        self._last_action = OrderedDict() # (chat_id, acción) -> último envío
+        self.dropped_actions = 0
+        self.retries = 0
+
+    @property
+    def waiting(self):
+        """Envíos esperando turno en su chat"""
+        return sum(1 for lane in self._lanes.values() if lane[0].locked())
+
+    def _lane(self, chat_id):
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            # Los ids negativos son grupos y canales
+            rate, burst = TELEGRAM_GROUP_RATE if chat_id < 0 else TELEGRAM_PRIVATE_RATE
+            lane = self._lanes[chat_id] = [asyncio.Lock(), TokenBucket(rate, burst), 0.0]
+            if len(self._lanes) > OUTBOX_MAX_CHATS:
+                for old_chat, old_lane in list(self._lanes.items())[:len(self._lanes) // 10]:
+                    if not old_lane[0].locked():
+                        del self._lanes[old_chat]
+        else:
+            self._lanes.move_to_end(chat_id)
+        return lane
+
+    async def send(self, chat_id, func, *args, **kwargs):
+        """Ejecuta func(*args, **kwargs) cuando lo permitan los límites, reintentando tras RetryAfter"""
+        lock, bucket, _ = lane = self._lane(chat_id)
+        async with lock:
+            for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+                wait = lane[2] - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await bucket.acquire()
+                await self.bucket.acquire()
+                try:
+                    return await func(*args, **kwargs)
+                except RetryAfter as e:
+                    retry_after = float(e.retry_after)
+                    lane[2] = time.monotonic() + retry_after
+                    logger.warning(f"Flood limit in chat {chat_id}, retrying in {retry_after}s")
+                    if attempt == TELEGRAM_MAX_RETRIES:
+                        raise
+                    self.retries += 1
+
+    async def chat_action(self, bot, chat_id, action="typing"):
+        """Envía una acción de chat si no se envió la misma hace poco"""
+        now = time.monotonic()
+        key = (chat_id, action)
+        if now - self._last_action.get(key, -CHAT_ACTION_INTERVAL) < CHAT_ACTION_INTERVAL:
+            self.dropped_actions += 1
+            return
+        
+        self._last_action[key] = now
+        self._last_action.move_to_end(key)
+        if len(self._last_action) > OUTBOX_MAX_CHATS:
+            self._last_action.popitem(last=False)
+        
+        # Si el chat está frenado por un RetryAfter, la acción no merece la espera
+        lane = self._lanes.get(chat_id)
+        if lane and lane[2] > now:
+            self.dropped_actions += 1
+            return
+        
+        try:
+            await self.bucket.acquire()
+            await bot.send_chat_action(chat_id=chat_id, action=action)
+        except RetryAfter as e:
+            self._lane(chat_id)[2] = time.monotonic() + float(e.retry_after)
+        except TelegramError as e:
+            logger.debug("Chat action failed in chat %s: %s", chat_id, e)
+
+class InlineSearches:
+    """Autocompletado del modo inline.
+    
+    Telegram envía una consulta por cada tecla: se espera a que el usuario
+    deje de escribir y, cuando llega una consulta nueva, se cancela la
+    búsqueda anterior del mismo usuario.
+    """
+
+    def __init__(self, movie_bot):
+        self.movie_bot = movie_bot
+        self._latest = {}  # user_id -> número de la última consulta recibida
+        self._tasks = {}   # user_id -> búsqueda en curso
+        self._order = itertools.count()
+        self.debounced = 0
+        self.cancelled = 0
+
+    async def search(self, user_id, text, debounce=True):
+        """Resultados de la consulta, o None si el mismo usuario ya envió otra más nueva"""
+        ticket = next(self._order)
+        self._latest[user_id] = ticket
+        previous = self._tasks.pop(user_id, None)
+        if previous and not previous.done():
+            previous.cancel()
+            self.cancelled += 1
+        
+        try:
+            if debounce:
+                await asyncio.sleep(INLINE_DEBOUNCE)
+                if self._latest.get(user_id) != ticket:
+                    self.debounced += 1
+                    return None
+            
+            task = asyncio.ensure_future(self.movie_bot.autocomplete(text))
+            self._tasks[user_id] = task
+            # wait() no propaga la cancelación de la búsqueda a este handler
+            await asyncio.wait({task})
+            if task.cancelled():
+                return None
+            return task.result()
+        finally:
+            if self._latest.get(user_id) == ticket:
+                del self._latest[user_id]
+                self._tasks.pop(user_id, None)
+
 # Instancia global del bot
 movie_bot = MovieBot()
+outbox = TelegramOutbox()
+group_filter = GroupMessageFilter(movie_bot.title_index)
+chat_locks = ChatLocks()
+inline_searches = InlineSearches(movie_bot)
+metrics = Metrics()
+
+@metrics.collector
+def collect_bot_metrics():
+    """Estado instantáneo de cachés, colas y servicios externos"""
+    samples = []
+    caches = dict(movie_bot.caches, render=movie_bot.render_cache)
+    for namespace, cache in caches.items():
+        stats = cache.stats()
+        labels = {"cache": namespace}
+        samples += [
+            ("mikalabaza_cache_hits_total", "counter", labels, stats["hits"]),
+            ("mikalabaza_cache_misses_total", "counter", labels, stats["misses"]),
+            ("mikalabaza_cache_evictions_total", "counter", labels, stats["evictions"]),
+            ("mikalabaza_cache_hit_ratio", "gauge", labels, stats["hit_ratio"]),
+            ("mikalabaza_cache_items", "gauge", labels, stats["items"]),
+            ("mikalabaza_cache_bytes", "gauge", labels, stats["bytes"])
+        ]
+    
+    for upstream, governor in movie_bot.governors.items():
+        labels = {"upstream": upstream}
+        samples += [
+            ("mikalabaza_upstream_active", "gauge", labels, governor.limiter.active),
+            ("mikalabaza_upstream_waiting", "gauge", labels, governor.limiter.waiting),
+            ("mikalabaza_upstream_used_today", "gauge", labels, governor.used_today),
+            ("mikalabaza_upstream_rejected_total", "counter", labels, governor.rejected),
+            ("mikalabaza_upstream_breaker_open", "gauge", labels,
+             int(movie_bot.breakers[upstream].state != "closed"))
+        ]
+    for upstream, count in movie_bot.warmer_stats.items():
+        samples.append(("mikalabaza_warmer_requests_total", "counter", {"upstream": upstream}, count))
+    for event, count in movie_bot.resilience_stats.items():
+        samples.append(("mikalabaza_resilience_events_total", "counter", {"event": event}, count))
+    samples.append(("mikalabaza_refreshes_inflight", "gauge", {}, len(movie_bot.refreshing)))
+    
+    samples += [
+        ("mikalabaza_inflight_requests", "gauge", {}, len(movie_bot.inflight)),
+        ("mikalabaza_coalesced_requests_total", "counter", {}, movie_bot.inflight.coalesced),
+        ("mikalabaza_abandoned_requests_total", "counter", {}, movie_bot.inflight.abandoned),
+        ("mikalabaza_overtaken_requests_total", "counter", {}, movie_bot.inflight.overtaken),
+        ("mikalabaza_inline_debounced_total", "counter", {}, inline_searches.debounced),
+        ("mikalabaza_inline_cancelled_total", "counter", {}, inline_searches.cancelled),
+        ("mikalabaza_chat_lock_waiting", "gauge", {}, chat_locks.waiting),
+        ("mikalabaza_outbox_waiting", "gauge", {}, outbox.waiting),
+        ("mikalabaza_outbox_retries_total", "counter", {}, outbox.retries),
+        ("mikalabaza_outbox_dropped_actions_total", "counter", {}, outbox.dropped_actions),
+        ("mikalabaza_group_searches_total", "counter", {}, group_filter.allowed)
+    ]
+    for reason, count in group_filter.saved.items():
+        samples.append(("mikalabaza_group_searches_saved_total", "counter", {"reason": reason}, count))
+    return samples
 
+@chat_locks.serialized
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando de inicio con mensaje creativo"""
     welcome_message = """
@@ -283,8 +2889,9 @@ Simplemente escribe el nombre de cualquier película o serie y te daré toda la
 💻 Powered by Makaveli para Mikaela con cariño... 🫶🏼
     """
     
-    await update.message.reply_text(welcome_message, parse_mode='Markdown')
+    await outbox.send(update.effective_chat.id, update.message.reply_text, welcome_message, parse_mode='Markdown')
 
+@chat_locks.serialized
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando de ayuda"""
     help_text = """
@@ -295,6 +2902,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 2. No necesitas comandos especiales
 3. Puedo entender títulos con errores tipográficos
 4. Funciono tanto en chats privados como en grupos.
+5. Envíame una lista de títulos (separados por comas o en líneas distintas) y te devuelvo un resumen con sus calificaciones.
 
 📋 **Comandos disponibles:**
 • `/start` - Mensaje de bienvenida
@@ -314,8 +2922,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ❓ **¿Problemas?** Asegúrate de escribir el título lo más completo posible.
     """
     
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await outbox.send(update.effective_chat.id, update.message.reply_text, help_text, parse_mode='Markdown')
 
+@chat_locks.serialized
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Información sobre el bot"""
     about_text = """
@@ -342,7 +2951,147 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💝 **¿Te gusta el bot?** ¡Compártelo con tus amigos cinéfilos!
     """
     
-    await update.message.reply_text(about_text, parse_mode='Markdown')
+    await outbox.send(update.effective_chat.id, update.message.reply_text, about_text, parse_mode='Markdown')
+
+BUSY_MESSAGE = "⏳ Hay muchas consultas en este momento. Inténtalo de nuevo en unos segundos."
+UNAVAILABLE_MESSAGE = "⚠️ El servicio de películas no responde ahora mismo. Inténtalo de nuevo en unos minutos."
+
+def upstream_error_message(error):
+    """Mensaje para el usuario según el tipo de fallo de la API"""
+    return BUSY_MESSAGE if isinstance(error, UpstreamBusy) else UNAVAILABLE_MESSAGE
+
+async def resolve_batch_entry(query):
+    """Resuelve un título de una lista y devuelve su línea del resumen"""
+    try:
+        match = await movie_bot.find_title(query)
+        if not match:
+            return f"❌ {escape_markdown(query)} — sin resultados"
+        
+        media_type = "tv" if match.get("media_type") == "tv" or match.get("first_air_date") else "movie"
+        details, omdb_data = await movie_bot.get_ratings_data(match["id"], media_type)
+        if not details:
+            return f"❌ {escape_markdown(query)} — sin detalles"
+        return movie_bot.format_summary(details, omdb_data)
+    except UpstreamError as e:
+        logger.warning(f"Batch entry '{query}' dropped, upstream failed: {e}")
+        return f"⚠️ {escape_markdown(query)} — servicio no disponible"
+    except Exception as e:
+        logger.error(f"Error resolving batch entry '{query}': {e}")
+        return f"❌ {escape_markdown(query)} — error"
+
+def batch_text(lines, pending, skipped):
+    """Mensaje de progreso/resumen de una lista"""
+    if pending:
+        header = f"📋 **Buscando {len(lines)} títulos...** ({len(lines) - pending}/{len(lines)})"
+    else:
+        header = f"📋 **Resumen de {len(lines)} títulos**"
+    text = header + "\n\n" + "\n".join(lines)
+    if skipped:
+        text += f"\n\n✂️ Solo se buscaron los primeros {BATCH_MAX_ITEMS} títulos."
+    if not pending:
+        text += "\n\n💡 Escribe un título para ver su ficha completa."
+    return text
+
+async def lookup_batch(update, titles):
+    """Busca una lista de títulos a la vez y va rellenando un único mensaje.
+    
+    Los títulos se resuelven en paralelo (los limitadores de cada API reparten
+    los turnos) y el mensaje se edita a medida que llegan, como mucho una vez
+    cada BATCH_EDIT_INTERVAL segundos para no chocar con los límites de Telegram.
+    """
+    chat_id = update.effective_chat.id
+    skipped = max(0, len(titles) - BATCH_MAX_ITEMS)
+    titles = titles[:BATCH_MAX_ITEMS]
+    lines = [f"⏳ {escape_markdown(title)}" for title in titles]
+    
+    message = await outbox.send(
+        chat_id,
+        update.message.reply_text,
+        batch_text(lines, len(titles), skipped),
+        parse_mode='Markdown'
+    )
+    
+    tasks = {asyncio.ensure_future(resolve_batch_entry(title)): i for i, title in enumerate(titles)}
+    pending = set(tasks)
+    last_edit = time.monotonic()
+    changed = False
+    try:
+        while pending:
+            timeout = max(0.0, last_edit + BATCH_EDIT_INTERVAL - time.monotonic()) if changed else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                lines[tasks[task]] = task.result()
+                changed = True
+            
+            if changed and (not pending or time.monotonic() - last_edit >= BATCH_EDIT_INTERVAL):
+                try:
+                    await outbox.send(
+                        chat_id,
+                        message.edit_text,
+                        batch_text(lines, len(pending), skipped),
+                        parse_mode='Markdown'
+                    )
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        logger.warning(f"Error editing batch summary: {e}")
+                last_edit = time.monotonic()
+                changed = False
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def reply_with_poster(message, poster_path, caption, keyboard):
+    """Responde con el póster, reutilizando el file_id si Telegram ya lo tiene.
+    
+    La primera vez se envía la URL de TMDB y se guarda el file_id devuelto,
+    así las siguientes respuestas no obligan a Telegram a descargar la imagen.
+    """
+    file_id = movie_bot.get_poster_file_id(poster_path)
+    if file_id:
+        try:
+            return await outbox.send(
+                message.chat_id,
+                message.reply_photo,
+                photo=file_id,
+                caption=caption,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
+        except BadRequest as e:
+            logger.warning(f"Cached poster file_id rejected for {poster_path}: {e}")
+            movie_bot.forget_poster(poster_path)
+    
+    sent = await outbox.send(
+        message.chat_id,
+        message.reply_photo,
+        photo=f"{TMDB_IMAGE_BASE}{poster_path}",
+        caption=caption,
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+    if sent.photo:
+        # La última variante es la de mayor resolución
+        movie_bot.remember_poster(poster_path, sent.photo[-1].file_id)
+    return sent
+
+def title_and_year(result):
+    """Título y año de un resultado de búsqueda de TMDB"""
+    if result.get("media_type") == "tv" or result.get("first_air_date"):
+        title = result.get("name", "Título desconocido")
+        year = result.get("first_air_date", "")[:4] if result.get("first_air_date") else ""
+    else:
+        title = result.get("title", "Título desconocido")
+        year = result.get("release_date", "")[:4] if result.get("release_date") else ""
+    return title, year
+
+def result_caption(result):
+    """Mensaje inicial de un título, con los botones de información debajo"""
+    title, year = title_and_year(result)
+    initial_message = f"🎬 **{title}**"
+    if year:
+        initial_message += f" ({year})"
+    initial_message += f"\n\n📊 Selecciona qué información quieres ver:"
+    return initial_message
 
 def create_info_keyboard(media_data):
     """Crea teclado con botones de información"""
@@ -368,6 +3117,8 @@ def create_info_keyboard(media_data):
     
     return InlineKeyboardMarkup(keyboard)
 
+@metrics.timed("handle_message")
+@chat_locks.serialized
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja mensajes que podrían ser títulos de películas/series"""
     message_text = update.message.text.strip()
@@ -376,46 +3127,72 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if message_text.startswith('/'):
         return
     
-    # Filtro básico para detectar posibles títulos
-    if len(message_text) < 2 or len(message_text) > 100:
+    # Filtro básico para detectar posibles títulos (las listas pueden ser más largas)
+    if len(message_text) < 2 or len(message_text) > BATCH_MAX_LENGTH:
         return
+    titles = split_title_list(message_text)
+    if not titles and len(message_text) > 100:
+        return
+    ambiguous = bool(titles) and may_be_single_title(message_text, titles)
     
     # En grupos, solo responder si nos mencionan o si parece un título claro
+    auto_detected = False
     if update.effective_chat.type in ['group', 'supergroup']:
         bot_username = context.bot.username
         if f"@{bot_username}" not in message_text:
+            auto_detected = True
+            # Las listas sin mención son conversación
+            if titles and not ambiguous:
+                return
             # Heurística simple: debe tener letras y posiblemente números/espacios
             if not re.match(r'^[a-zA-ZñÑáéíóúÁÉÍÓÚ0-9\s\-:.,\'\"]+$', message_text):
                 return
-            # Muy corto o muy común, probablemente no es un título
-            if len(message_text) < 3 or message_text.lower() in ['si', 'no', 'ok', 'hola', 'que', 'como']:
+            # Muy corto, probablemente no es un título
+            if len(message_text) < 3:
+                return
+            # Conversación normal: palabras vacías, palabras que no salen en ningún título...
+            if not group_filter.check(update.effective_chat.id, message_text):
                 return
         else:
             # Si nos mencionaron, extraer el título
             message_text = message_text.replace(f"@{bot_username}", "").strip()
+            titles = split_title_list(message_text)
+            ambiguous = bool(titles) and may_be_single_title(message_text, titles)
+    
+    # La detección automática en grupos tiene menos prioridad que las consultas directas
+    request_priority.set(PRIORITY_BACKGROUND if auto_detected else PRIORITY_SEARCH)
     
     # Mostrar que está escribiendo
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+    await outbox.chat_action(context.bot, update.effective_chat.id)
+    
+    if titles and not ambiguous:
+        await lookup_batch(update, titles)
+        return
     
     try:
-        # Buscar en TMDB
-        results = await movie_bot.search_tmdb(message_text)
-        
-        if not results:
-            await update.message.reply_text(
-                f"🔍 No encontré resultados para '{message_text}'\n\n"
-                "💡 **Consejos:**\n"
-                "• Verifica la ortografía\n"
-                "• Prueba con el título en inglés\n"
-                "• Usa títulos más específicos"
-            )
-            return
+        # Buscar en el índice local y en TMDB, y elegir la mejor coincidencia.
+        # Un texto con coma que quizá sea una lista no merece probar variantes.
+        best_match = await movie_bot.find_title(message_text, fan_out=not titles)
         
-        # Encontrar la mejor coincidencia
-        best_match = movie_bot.find_best_match(message_text, results)
+        # Con una coma, el texto es un único título solo si coincide claramente como tal
+        if titles and not movie_bot.is_single_title(message_text, titles, best_match):
+            # En grupos, las listas sin mención son conversación
+            if not auto_detected:
+                await lookup_batch(update, titles)
+            return
         
         if not best_match:
-            await update.message.reply_text("❌ No pude encontrar una coincidencia adecuada.")
+            # En grupos, un mensaje que no era un título no merece respuesta
+            if not auto_detected:
+                await outbox.send(
+                    update.effective_chat.id,
+                    update.message.reply_text,
+                    f"🔍 No encontré resultados para '{message_text}'\n\n"
+                    "💡 **Consejos:**\n"
+                    "• Verifica la ortografía\n"
+                    "• Prueba con el título en inglés\n"
+                    "• Usa títulos más específicos"
+                )
             return
         
         # Determinar tipo de media
@@ -423,79 +3200,90 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Obtener poster si está disponible
         poster_path = best_match.get("poster_path")
-        poster_url = f"{TMDB_IMAGE_BASE}{poster_path}" if poster_path else None
         
         # Crear mensaje inicial con título y poster
-        if media_type == "tv":
-            title = best_match.get("name", "Título desconocido")
-            year = best_match.get("first_air_date", "")[:4] if best_match.get("first_air_date") else ""
-        else:
-            title = best_match.get("title", "Título desconocido")
-            year = best_match.get("release_date", "")[:4] if best_match.get("release_date") else ""
-        
-        initial_message = f"🎬 **{title}**"
-        if year:
-            initial_message += f" ({year})"
-        initial_message += f"\n\n📊 Selecciona qué información quieres ver:"
+        initial_message = result_caption(best_match)
         
         keyboard = create_info_keyboard(best_match)
         
-        if poster_url:
+        # Adelantar detalles y calificaciones mientras el usuario elige un botón
+        movie_bot.prefetch(best_match["id"], media_type, update.effective_chat.id)
+        
+        if poster_path:
             try:
-                await update.message.reply_photo(
-                    photo=poster_url,
-                    caption=initial_message,
-                    reply_markup=keyboard,
-                    parse_mode='Markdown'
-                )
-            except:
+                await reply_with_poster(update.message, poster_path, initial_message, keyboard)
+            except TelegramError as e:
+                logger.warning(f"Error sending poster {poster_path}: {e}")
                 # Si falla la imagen, enviar solo texto
-                await update.message.reply_text(
+                await outbox.send(
+                    update.effective_chat.id,
+                    update.message.reply_text,
                     initial_message,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
                 )
         else:
-            await update.message.reply_text(
+            await outbox.send(
+                update.effective_chat.id,
+                update.message.reply_text,
                 initial_message,
                 reply_markup=keyboard,
                 parse_mode='Markdown'
             )
     
+    except UpstreamError as e:
+        logger.warning(f"Search dropped, upstream failed: {e}")
+        # En grupos no se insiste si nadie nos pidió nada
+        if not auto_detected:
+            await outbox.send(update.effective_chat.id, update.message.reply_text, upstream_error_message(e))
+    
     except Exception as e:
         logger.error(f"Error handling message: {e}")
-        await update.message.reply_text(
+        await outbox.send(
+            update.effective_chat.id,
+            update.message.reply_text,
             "❌ Ocurrió un error al procesar tu solicitud. Por favor, inténtalo de nuevo."
         )
 
+@metrics.timed("button_callback")
+@chat_locks.serialized
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja los callbacks de los botones - VERSIÓN CORREGIDA"""
     query = update.callback_query
     await query.answer()
+    # Los mensajes enviados en modo inline no llegan con el chat: se limita por usuario
+    chat_id = query.message.chat_id if query.message else query.from_user.id
+    has_photo = bool(query.message and query.message.photo)
     
-    # Log para debug
-    logger.info(f"Callback received: {query.data}")
+    # Log para debug (con argumentos: no se formatea si DEBUG está desactivado)
+    logger.debug("Callback received: %s", query.data)
     
     if query.data == "new_search":
         try:
             # Intentar editar el mensaje, si falla enviar uno nuevo
-            if query.message.photo:
+            if has_photo:
                 # Si es una foto, enviar mensaje nuevo
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
+                await outbox.send(
+                    chat_id,
+                    context.bot.send_message,
+                    chat_id=chat_id,
                     text="🔍 **Nueva búsqueda**\n\nEscribe el nombre de otra película o serie que quieras buscar.",
                     parse_mode='Markdown'
                 )
             else:
                 # Si es texto, editar
-                await query.edit_message_text(
+                await outbox.send(
+                    chat_id,
+                    query.edit_message_text,
                     "🔍 **Nueva búsqueda**\n\nEscribe el nombre de otra película o serie que quieras buscar.",
                     parse_mode='Markdown'
                 )
         except Exception as e:
             logger.error(f"Error in new_search: {e}")
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
+            await outbox.send(
+                chat_id,
+                context.bot.send_message,
+                chat_id=chat_id,
                 text="🔍 **Nueva búsqueda**\n\nEscribe el nombre de otra película o serie que quieras buscar.",
                 parse_mode='Markdown'
             )
@@ -506,109 +3294,256 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = query.data.split('|')
         if len(parts) != 3:
             logger.error(f"Invalid callback data format: {query.data}")
-            await query.edit_message_text("❌ Error en los datos del botón.")
+            await outbox.send(chat_id, query.edit_message_text, "❌ Error en los datos del botón.")
             return
             
         action, tmdb_id, media_type = parts
         tmdb_id = int(tmdb_id)
         
-        logger.info(f"Parsed: action={action}, id={tmdb_id}, type={media_type}")
+        logger.debug("Parsed: action=%s, id=%s, type=%s", action, tmdb_id, media_type)
         
     except (ValueError, IndexError) as e:
         logger.error(f"Error parsing callback data: {e}")
-        await query.edit_message_text("❌ Error en los datos del botón.")
+        await outbox.send(chat_id, query.edit_message_text, "❌ Error en los datos del botón.")
         return
     
+    # Los botones de una consulta en curso van por delante de todo lo demás
+    request_priority.set(PRIORITY_INTERACTIVE)
+    
     # Mostrar indicador de carga
-    await context.bot.send_chat_action(chat_id=query.message.chat_id, action="typing")
+    if query.message:
+        await outbox.chat_action(context.bot, chat_id)
     
     try:
-        # Obtener detalles completos de TMDB
-        logger.info(f"Fetching TMDB details for {media_type} ID {tmdb_id}")
-        tmdb_details = await movie_bot.get_tmdb_details(tmdb_id, media_type)
+        # Obtener el contenido (desde caché si los datos no cambiaron)
+        logger.debug("Rendering %s for %s ID %s", action, media_type, tmdb_id)
+        rendered = await movie_bot.render(action, tmdb_id, media_type)
         
-        if not tmdb_details:
+        if not rendered:
             logger.error(f"No TMDB details found for {media_type} ID {tmdb_id}")
-            await query.edit_message_text("❌ No se pudieron obtener los detalles.")
+            await outbox.send(chat_id, query.edit_message_text, "❌ No se pudieron obtener los detalles.")
             return
         
-        # Obtener datos de OMDB para calificaciones adicionales
-        omdb_data = None
-        if action == "ratings":
-            title = tmdb_details.get("title") or tmdb_details.get("name")
-            if title:
-                year = None
-                if tmdb_details.get("release_date"):
-                    year = tmdb_details["release_date"][:4]
-                elif tmdb_details.get("first_air_date"):
-                    year = tmdb_details["first_air_date"][:4]
-                
-                omdb_data = await movie_bot.search_omdb(title, year, "movie" if media_type == "movie" else "series")
-        
-        # Generar contenido según la acción
-        if action == "basic":
-            content = movie_bot.format_basic_info(tmdb_details, omdb_data)
-        elif action == "ratings":
-            content = movie_bot.format_ratings(tmdb_details, omdb_data)
-        elif action == "cast":
-            content = movie_bot.format_cast_crew(tmdb_details)
-        elif action == "watch":
-            content = movie_bot.format_where_to_watch(tmdb_details, omdb_data)
-        else:
-            content = "❌ Acción no reconocida."
-            logger.error(f"Unknown action: {action}")
-        
-        # Crear nuevo keyboard
-        keyboard = create_info_keyboard({
-            'id': tmdb_id, 
-            'media_type': media_type,
-            'first_air_date': tmdb_details.get('first_air_date')
-        })
+        content, keyboard = rendered
         
         # Intentar editar mensaje
         try:
-            if query.message.photo:
+            if has_photo:
                 # Si el mensaje original tiene foto, editar solo el caption
-                await query.edit_message_caption(
+                await outbox.send(
+                    chat_id,
+                    query.edit_message_caption,
                     caption=content,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
                 )
             else:
                 # Si es solo texto, editar el texto
-                await query.edit_message_text(
+                await outbox.send(
+                    chat_id,
+                    query.edit_message_text,
                     content,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
                 )
-        except Exception as edit_error:
+        except BadRequest as edit_error:
+            # Pulsar dos veces el mismo botón no cambia nada: no hace falta otro mensaje
+            if "not modified" in str(edit_error).lower():
+                return
             logger.error(f"Error editing message: {edit_error}")
             # Si no se puede editar, enviar mensaje nuevo
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
+            await outbox.send(
+                chat_id,
+                context.bot.send_message,
+                chat_id=chat_id,
                 text=content,
                 reply_markup=keyboard,
                 parse_mode='Markdown'
             )
     
+    except UpstreamError as e:
+        logger.warning(f"Button dropped, upstream failed: {e}")
+        try:
+            await outbox.send(
+                chat_id,
+                query.edit_message_text,
+                upstream_error_message(e),
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🔄 Reintentar", callback_data=query.data)
+                ]])
+            )
+        except TelegramError:
+            await outbox.send(chat_id, context.bot.send_message, chat_id=chat_id, text=upstream_error_message(e))
+    
     except Exception as e:
         logger.error(f"Error in button callback: {e}")
         try:
-            await query.edit_message_text(
+            await outbox.send(
+                chat_id,
+                query.edit_message_text,
                 "❌ Ocurrió un error al obtener la información. Inténtalo de nuevo.",
                 reply_markup=InlineKeyboardMarkup([[
                     InlineKeyboardButton("🔄 Reintentar", callback_data=query.data)
                 ]])
             )
-        except:
+        except TelegramError:
             # Si no se puede editar, enviar mensaje nuevo
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
+            await outbox.send(
+                chat_id,
+                context.bot.send_message,
+                chat_id=chat_id,
                 text="❌ Ocurrió un error al obtener la información. Inténtalo de nuevo."
             )
 
+def inline_article(result):
+    """Tarjeta de resultado inline para un título"""
+    title, year = title_and_year(result)
+    media_type = "tv" if result.get("media_type") == "tv" or result.get("first_air_date") else "movie"
+    original_title = result.get("original_name" if media_type == "tv" else "original_title", "")
+    
+    description = "📺 Serie TV" if media_type == "tv" else "🎬 Película"
+    if original_title and original_title != title:
+        description += f" • {original_title}"
+    
+    poster_path = result.get("poster_path")
+    return InlineQueryResultArticle(
+        id=f"{media_type}:{result['id']}",
+        title=f"{title} ({year})" if year else title,
+        description=description,
+        thumbnail_url=f"{TMDB_THUMB_BASE}{poster_path}" if poster_path else None,
+        input_message_content=InputTextMessageContent(result_caption(result), parse_mode='Markdown'),
+        reply_markup=create_info_keyboard(result)
+    )
+
+@metrics.timed("inline_query")
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Autocompletado inline: @bot título desde cualquier chat"""
+    query = update.inline_query
+    text = query.query.strip()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    
+    if len(text) < INLINE_MIN_QUERY or len(text) > 100:
+        await query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    
+    request_priority.set(PRIORITY_SEARCH)
+    try:
+        # Al pedir más páginas el usuario ya no está escribiendo: sin espera
+        results = await inline_searches.search(query.from_user.id, text, debounce=offset == 0)
+        if results is None:
+            # Hay una consulta más nueva del mismo usuario; Telegram descarta esta
+            return
+        
+        page = results[offset:offset + INLINE_PAGE_SIZE]
+        next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(results) else ""
+        await query.answer(
+            [inline_article(result) for result in page],
+            cache_time=INLINE_CACHE_TIME,
+            next_offset=next_offset
+        )
+    except BadRequest as e:
+        # La consulta caducó mientras se buscaba
+        logger.debug("Inline answer rejected for '%s': %s", text, e)
+    except Exception as e:
+        logger.error(f"Error in inline query: {e}")
+
+async def on_startup(application: Application):
+    """Se ejecuta al iniciar la aplicación"""
+    await movie_bot.init_session()
+    if CACHE_DB_PATH or CACHE_BACKEND == "memory":
+        await movie_bot.open_store(CACHE_DB_PATH, CACHE_BACKEND)
+    if TITLE_DUMP_PATH:
+        await movie_bot.load_title_dump(TITLE_DUMP_PATH)
+    if METRICS_PORT:
+        metrics.collector(lambda: [
+            ("mikalabaza_pending_updates", "gauge", {}, application.update_queue.qsize())
+        ])
+        await metrics.start_server(METRICS_HOST, METRICS_PORT)
+    if WARMER_ENABLED:
+        movie_bot.start_warmer()
+    if REFRESH_ENABLED:
+        movie_bot.start_refresher()
+
+async def on_shutdown(application: Application):
+    """Se ejecuta al detener la aplicación"""
+    movie_bot.stop_warmer()
+    movie_bot.stop_refresher()
+    movie_bot.cancel_prefetches()
+    await metrics.stop_server()
+    await movie_bot.close_store()
+    await movie_bot.close_session()
+
+def build_webhook_app(application: Application):
+    """Servidor aiohttp que recibe los updates de Telegram y expone /health"""
+    async def telegram_webhook(request):
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        
+        # Se encola y se responde enseguida; la aplicación procesa el update aparte
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+    
+    async def health(request):
+        return web.json_response({
+            "status": "ok",
+            "pending_updates": application.update_queue.qsize()
+        })
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.router.add_get("/health", health)
+    return app
+
+async def run_webhook(application: Application):
+    """Ejecuta el bot en modo webhook hasta recibir SIGINT o SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    
+    runner = web.AppRunner(build_webhook_app(application), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja errores globales"""
+    if isinstance(context.error, RetryAfter):
+        logger.warning(f"Telegram flood limit reached, retry after {context.error.retry_after}s")
+        return
     logger.error(f"Update {update} caused error {context.error}")
 
 def main():
@@ -620,8 +3555,25 @@ def main():
         print("❌ ERROR: Faltan tokens de API!")
         return
     
-    # Crear aplicación
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        print("❌ ERROR: Falta WEBHOOK_URL para el modo webhook!")
+        return
+    
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        print("❌ ERROR: Falta WEBHOOK_SECRET para el modo webhook!")
+        return
+    
+    # Crear aplicación (en modo webhook no hace falta el updater de polling)
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Agregar handlers
     application.add_handler(CommandHandler("start", start))
@@ -629,21 +3581,25 @@ def main():
     application.add_handler(CommandHandler("about", about_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(InlineQueryHandler(inline_query))
     application.add_error_handler(error_handler)
     
     print("✅ Bot configurado correctamente")
-    print("🚀 Iniciando polling...")
+    if BOT_MODE == "webhook":
+        print(f"🌐 Iniciando webhook en el puerto {WEBHOOK_PORT}...")
+    else:
+        print("🚀 Iniciando polling...")
     print("📱 Busca tu bot en Telegram y escribe /start")
     print("🛑 Presiona Ctrl+C para detener")
     
     # Iniciar bot
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
     except KeyboardInterrupt:
         print("\n🛑 Bot detenido por el usuario")
-    finally:
-        # Limpiar recursos
-        asyncio.run(movie_bot.close_session())
 
 if __name__ == '__main__':
     main()